@@ -1,5 +1,5 @@
-import random
 import sys
+import numpy as np
 sys.path.insert(1, '.')
 from source import DawnSim
 
@@ -74,11 +74,9 @@ class Node(DawnSim.BaseNode):
 ###########################################################
 def create_network():
     # place nodes over 100x100 grids
-    for x in range(10):
-        for y in range(10):
-            px = 50 + x * 60 + random.uniform(-20, 20)
-            py = 50 + y * 60 + random.uniform(-20, 20)
-            sim.add_node(Node, pos=(px, py), tx_range=75)
+    grid = np.array([(50 + x * 60, 50 + y * 60) for x in range(10) for y in range(10)], dtype=float)
+    positions = grid + np.random.uniform(-20, 20, grid.shape)
+    sim.add_nodes(Node, positions, tx_ranges=75)
 
 
 # setting the simulation
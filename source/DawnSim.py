@@ -4,11 +4,23 @@ Author: Mustafa Tosun
 """
 
 import bisect
+import functools
+import heapq
 import inspect
+import itertools
+import math
 import random
+import time
+from operator import itemgetter
+import numpy as np
 import simpy
+from simpy.core import EmptySchedule, Infinity, StopSimulation
 from simpy.util import start_delayed
 from source import config
+from source.config import SimConfig
+from source import scenario
+from source.logsink import LogSink, DEBUG, INFO, WARNING, ERROR, OFF
+from source.mobility import StepMobility, AnalyticMobility, RandomWaypoint, RandomDirection
 
 BROADCAST_ADDR = config.BROADCAST_ADDR
 """double: Keeps broadcast address.
@@ -31,6 +43,15 @@ def ensure_generator(env, func, *args, **kwargs):
         return _wrapper()
 
 
+###########################################################
+def _until_interrupted(generator):
+    """Runs a process generator and ends the process quietly when it is interrupted."""
+    try:
+        yield from generator
+    except simpy.Interrupt:
+        pass
+
+
 ###########################################################
 def distance(pos1, pos2):
     """Calculates the distance between two positions.
@@ -45,6 +66,341 @@ def distance(pos1, pos2):
     return ((pos1[0] - pos2[0]) ** 2 + (pos1[1] - pos2[1]) ** 2) ** 0.5
 
 
+###########################################################
+class Environment(simpy.Environment):
+    """SimPy environment with an additional lightweight event queue. Plain callbacks are kept in a heap
+    of [time, sequence, callback, args] entries instead of SimPy processes, and both queues are processed
+    in time order. Generator functions still run as SimPy processes. Canceled entries stay in the heap
+    with their callback cleared and are dropped when they reach the top.
+
+       Attributes:
+           calls (List of List): Heap of scheduled callbacks.
+
+    """
+
+    ############################
+    def __init__(self, initial_time=0):
+        """Constructor for Environment class.
+
+           Args:
+               initial_time (double): Start time of simulation.
+
+           Returns:
+               Environment: Created Environment object.
+        """
+        simpy.Environment.__init__(self, initial_time)
+        self.calls = []
+        self._sequence = itertools.count()
+        self._canceled = 0
+
+    ############################
+    def call_later(self, delay, callback, *args):
+        """Schedules a callback to be called after a given delay.
+
+           Args:
+               delay (double): Delay duration.
+               callback (Function): Function to call.
+               *args: Arguments of callback.
+
+           Returns:
+               List: Scheduled entry. It can be passed to cancel().
+        """
+        entry = [self._now + delay, next(self._sequence), callback, args]
+        heapq.heappush(self.calls, entry)
+        return entry
+
+    ############################
+    def call_at(self, at, callback, *args):
+        """Schedules a callback to be called at a given time.
+
+           Args:
+               at (double): Time to call.
+               callback (Function): Function to call.
+               *args: Arguments of callback.
+
+           Returns:
+               List: Scheduled entry. It can be passed to cancel().
+        """
+        entry = [at, next(self._sequence), callback, args]
+        heapq.heappush(self.calls, entry)
+        return entry
+
+    ############################
+    def cancel(self, entry):
+        """Cancels a scheduled callback in constant time. Nothing happens if it has already been called
+        or canceled.
+
+           Args:
+               entry (List): Entry returned by call_later().
+
+           Returns:
+
+        """
+        if entry[2] is None:
+            return
+        entry[2] = entry[3] = None
+        self._canceled += 1
+        calls = self.calls
+        if self._canceled > 64 and 2 * self._canceled > len(calls):
+            calls[:] = [e for e in calls if e[2] is not None]
+            heapq.heapify(calls)
+            self._canceled = 0
+
+    ############################
+    def _drop_canceled(self):
+        calls = self.calls
+        while calls and calls[0][2] is None:
+            heapq.heappop(calls)
+            self._canceled -= 1
+
+    ############################
+    def peek(self):
+        """Gets the time of the next event in any of the queues.
+
+           Args:
+
+           Returns:
+               double: Time of the next event. It is Infinity if there are no events.
+        """
+        self._drop_canceled()
+        time = simpy.Environment.peek(self)
+        if self.calls and self.calls[0][0] < time:
+            return self.calls[0][0]
+        return time
+
+    ############################
+    def step(self):
+        """Processes the next event. SimPy events go first when both queues have events at the same time.
+
+           Args:
+
+           Returns:
+
+        """
+        self._drop_canceled()
+        calls = self.calls
+        if calls and (not self._queue or calls[0][0] < self._queue[0][0]):
+            entry = heapq.heappop(calls)
+            self._now, _, callback, args = entry
+            entry[2] = None
+            callback(*args)
+        else:
+            simpy.Environment.step(self)
+
+    ############################
+    def run_events(self, until=Infinity, condition=None, interval=0):
+        """Processes events in time order until a given time, or until no events remain, stop() is called or
+        a condition becomes True. It does the same as calling step() in a loop, without its overhead.
+
+           Args:
+               until (double): Time to stop. Events at or after it are not processed and time is set to it.
+               condition (Function): Function without arguments. Processing stops when it returns True.
+               interval (double): Simulation time between two checks of condition. If it is 0, condition
+                is checked after every event.
+
+           Returns:
+               string: Why processing stopped, 'duration', 'idle', 'stopped' or 'condition'.
+        """
+        calls = self.calls
+        queue = self._queue
+        heappop = heapq.heappop
+        simpy_step = simpy.Environment.step
+        next_check = self._now
+        try:
+            while True:
+                while calls and calls[0][2] is None:
+                    heappop(calls)
+                    self._canceled -= 1
+                if calls and (not queue or calls[0][0] < queue[0][0]):
+                    entry = calls[0]
+                    if entry[0] >= until:
+                        self._now = until
+                        return 'duration'
+                    heappop(calls)
+                    self._now, _, callback, args = entry
+                    entry[2] = None
+                    callback(*args)
+                elif queue:
+                    if queue[0][0] >= until:
+                        self._now = until
+                        return 'duration'
+                    simpy_step(self)
+                else:
+                    return 'idle'
+                if condition is not None and self._now >= next_check:
+                    if condition():
+                        return 'condition'
+                    next_check = self._now + interval
+        except StopSimulation:
+            return 'stopped'
+
+    ############################
+    def stop(self):
+        """Makes run_events() return after the events scheduled for the current time. It is put into the
+        event queue, so that the loop does not check a flag after every event.
+
+           Args:
+
+           Returns:
+
+        """
+        self.call_at(self._now, self._stop)
+
+    ############################
+    def _stop(self):
+        raise StopSimulation('stop')
+
+
+###########################################################
+class RealtimeEnvironment(Environment, simpy.rt.RealtimeEnvironment):
+    """Environment with a lightweight event queue which is synchronized with the wall-clock time.
+    """
+
+    ############################
+    def __init__(self, initial_time=0, factor=1.0, strict=False):
+        """Constructor for RealtimeEnvironment class.
+
+           Args:
+               initial_time (double): Start time of simulation.
+               factor (double): Seconds in real time for 1 second in simulation.
+               strict (bool): If it is True, an error is raised when simulation is slower than real time.
+
+           Returns:
+               RealtimeEnvironment: Created RealtimeEnvironment object.
+        """
+        simpy.rt.RealtimeEnvironment.__init__(self, initial_time, factor, strict)
+        self.calls = []
+        self._sequence = itertools.count()
+        self._canceled = 0
+
+    ############################
+    def step(self):
+        """Waits until the wall-clock time of the next event, then processes it.
+
+           Args:
+
+           Returns:
+
+        """
+        event_time = self.peek()
+        if event_time == Infinity:
+            raise EmptySchedule()
+        real_time = self.real_start + (event_time - self.env_start) * self.factor
+        if self.strict and time.monotonic() - real_time > self.factor:
+            raise RuntimeError(f'Simulation too slow for real time ({time.monotonic() - real_time:.3f}s).')
+        while True:
+            delay = real_time - time.monotonic()
+            if delay <= 0:
+                break
+            time.sleep(delay)
+        Environment.step(self)
+
+    ############################
+    def run_events(self, until=Infinity, condition=None, interval=0):
+        """Processes events in time order like Environment.run_events(), waiting for the wall-clock time of
+        each event.
+
+           Args:
+               until (double): Time to stop. Events at or after it are not processed and time is set to it.
+               condition (Function): Function without arguments. Processing stops when it returns True.
+               interval (double): Simulation time between two checks of condition. If it is 0, condition
+                is checked after every event.
+
+           Returns:
+               string: Why processing stopped, 'duration', 'idle', 'stopped' or 'condition'.
+        """
+        next_check = self._now
+        try:
+            while True:
+                event_time = self.peek()
+                if event_time == Infinity:
+                    return 'idle'
+                if event_time >= until:
+                    self._now = until
+                    return 'duration'
+                self.step()
+                if condition is not None and self._now >= next_check:
+                    if condition():
+                        return 'condition'
+                    next_check = self._now + interval
+        except StopSimulation:
+            return 'stopped'
+
+
+###########################################################
+def neighbor_pairs(positions, tx_ranges, cell_size, first=0, block_size=4096):
+    """Finds every directed link between nodes with a vectorized pass over a uniform grid.
+    A link (src, dst) exists if the distance between them is not greater than transmission range of src.
+    Only the links having an end at index first or above are returned, so that newly appended
+    nodes can be linked to the existing ones.
+
+       Args:
+           positions (numpy.ndarray): Array of positions with shape (N, 2).
+           tx_ranges (numpy.ndarray): Array of transmission ranges with shape (N,).
+           cell_size (double): Side length of grid cells.
+           first (int): Index of the first new node.
+           block_size (int): Number of new nodes processed at once. It bounds the memory used.
+
+       Returns:
+           Tuple(numpy.ndarray,numpy.ndarray,numpy.ndarray): Source indices, destination indices and distances.
+    """
+    count = len(positions)
+    srcs, dsts, dists = [np.empty(0, np.int64)], [np.empty(0, np.int64)], [np.empty(0)]
+    if count == 0:
+        return srcs[0], dsts[0], dists[0]
+    rings = math.ceil(tx_ranges.max() / cell_size)
+    cells = np.floor(positions / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0)
+    width = int(cells[:, 1].max()) + 2 * rings + 1
+    keys = cells[:, 0] * width + cells[:, 1] + rings
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    offsets = [dx * width + dy for dx in range(-rings, rings + 1) for dy in range(-rings, rings + 1)]
+
+    for start in range(first, count, block_size):
+        queries = np.arange(start, min(start + block_size, count))
+        qs, cs = [], []
+        for offset in offsets:
+            lo = np.searchsorted(sorted_keys, keys[queries] + offset, side='left')
+            hi = np.searchsorted(sorted_keys, keys[queries] + offset, side='right')
+            counts = hi - lo
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            ends = np.cumsum(counts)
+            within = np.arange(total) - np.repeat(ends - counts, counts)
+            qs.append(np.repeat(queries, counts))
+            cs.append(order[np.repeat(lo, counts) + within])
+        if not qs:
+            continue
+        q = np.concatenate(qs)
+        c = np.concatenate(cs)
+        keep = q != c
+        q, c = q[keep], c[keep]
+        d = np.hypot(positions[q, 0] - positions[c, 0], positions[q, 1] - positions[c, 1])
+        # links from the new node to any node
+        out = d <= tx_ranges[q]
+        srcs.append(q[out])
+        dsts.append(c[out])
+        dists.append(d[out])
+        # links from the existing nodes to the new node, new pairs are found from both ends
+        inc = (c < first) & (d <= tx_ranges[c])
+        srcs.append(c[inc])
+        dsts.append(q[inc])
+        dists.append(d[inc])
+    return np.concatenate(srcs), np.concatenate(dsts), np.concatenate(dists)
+
+
+###########################################################
+def _group_bounds(keys):
+    """Yields each distinct key of a sorted array with the slice bounds of its run."""
+    if len(keys) == 0:
+        return
+    uniques, starts = np.unique(keys, return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    yield from zip(uniques.tolist(), starts.tolist(), ends.tolist())
+
+
 ###########################################################
 class BaseNode:
     """Class to model a network node with basic operations. It's base class for more complex node classes.
@@ -54,12 +410,19 @@ class BaseNode:
            tx_range (double): Transmission range of node.
            sim (Simulator): Simulation environment of node.
            id (int): Global unique ID of node.
-           timers (List of Timer): Keeps timers set by node
+           timers (Dict of Timer to None): Keeps active timers set by node in the order they were set.
+            Timers are removed when they expire or are killed.
            is_sleeping (bool): If it is True, It means node is sleeping and can not receive messages.
            Otherwise, node is awaken.
-           logging (bool): It is a flag for logging. If it is True, nodes outputs can be seen in terminal.
-           neighbor_distance_list (List of Tuple(double,Node)): Sorted list of nodes distances to other nodes.
-            Each Tuple keeps a distance and a node id.
+           is_failed (bool): If it is True, node is crashed or removed. It is not in neighbor lists of other
+            nodes and does not run or receive anything.
+           is_removed (bool): If it is True, node is removed from network and can not recover.
+           logging (bool): It is a flag for logging. If it is True, nodes outputs are written to the log sink
+            of simulator.
+           neighbor_distance_list (List of Tuple(double,Node)): Sorted list of distances to the nodes within
+            transmission range plus the neighbor margin of simulator. Each Tuple keeps a distance and a node.
+           links (Dict of int to Tuple(double,Node)): Entries of neighbor_distance_list by node id.
+           in_neighbors (Dict of int to Node): Nodes whose neighbor_distance_list contains this node.
            timeout (Function): timeout function
 
     """
@@ -77,15 +440,31 @@ class BaseNode:
            Returns:
                Node: Created node object.
         """
+        self._motion = None
         self.pos = pos
         self.tx_range = tx_range
         self.sim = sim
         self.id = id
-        self.timers = []
+        self.timers = {}
         self.is_sleeping = False
+        self.is_failed = False
+        self.is_removed = False
         self.logging = True
         self.neighbor_distance_list = []
+        self.links = {}
+        self.in_neighbors = {}
+        self._tx_links = None
         self.timeout = self.sim.timeout
+        self._batch_receive = type(self).on_receive_batch is not BaseNode.on_receive_batch
+        self._neighbor_hooks = (type(self).on_neighbor_up is not BaseNode.on_neighbor_up or
+                                type(self).on_neighbor_down is not BaseNode.on_neighbor_down)
+        self._inbox = []
+        self._process = None
+        self._incarnation = 0
+        self._deferred = []
+        self._duty_cycle = None
+        if self._neighbor_hooks:
+            sim._neighbor_hooks = True
 
     ############################
     def __repr__(self):
@@ -126,20 +505,48 @@ class BaseNode:
         return self.sim.env.now
 
     ############################
-    def log(self, msg):
-        """Writes outputs of node to terminal.
+    @property
+    def pos(self):
+        """Property for position of node. If node is moved by analytic mobility, it is computed for the
+        current time of simulation.
+
+           Args:
+
+           Returns:
+               Tuple(double,double): Position of node.
+        """
+        motion = self._motion
+        if motion is None:
+            return self._pos
+        (x, y, vx, vy, start, end) = motion
+        elapsed = min(self.sim.env.now, end) - start
+        return (x + vx * elapsed, y + vy * elapsed)
+
+    ############################
+    @pos.setter
+    def pos(self, pos):
+        self._pos = pos
+
+    ############################
+    def log(self, msg, *args, level=INFO, category=None):
+        """Writes outputs of node to the log sink of simulator. Message is formatted with args only when
+        the record is written, so disabled logs cost almost nothing.
 
            Args:
-                msg (string): Output text
+                msg (string): Output text. It can contain %-style placeholders for args.
+                *args: Arguments of placeholders.
+                level (int): Level of output, e.g. DEBUG, INFO, WARNING or ERROR.
+                category (string): Category of output to filter.
            Returns:
 
         """
-        if self.logging:
-            print(f"Node {'#' + str(self.id):4}[{self.now:10.5f}] {msg}")
+        if self.logging and level >= self.sim.log_sink.level:
+            self.sim.log_sink.write(self.sim.env.now, self.id, level, category, msg, args)
 
     ############################
     def send(self, dest, pck):
         """Sends given package. If dest address is broadcast address, it sends the package to all neighbors.
+        Otherwise, it is sent only if dest is in transmission range, which is found with a single lookup.
 
            Args:
                 pck (Dict): Package to be sent. It should contain 'dest' which is destination address.
@@ -147,18 +554,48 @@ class BaseNode:
            Returns:
 
         """
-        for (dist, node) in self.neighbor_distance_list:
-            if dist <= self.tx_range:
-                if dest == BROADCAST_ADDR or dest == node.id:
-                    if config.SIM_MESSAGGING_DELAY_TYPE == 'prop':
-                        prop_time = dist / 3000000
-                    elif config.SIM_MESSAGGING_DELAY_TYPE == 'random':
-                        prop_time = random.random()
-                    else:
-                        prop_time = config.SIM_MESSAGGING_CONSTANT_DELAY
-                    self.delayed_exec(prop_time, node.on_receive_check, pck)
-            else:
-                break
+        if dest != BROADCAST_ADDR:
+            link = self.links.get(dest)
+            if link is None or link[0] > self.tx_range:
+                return
+            (dist, node) = link
+            if self.sim.mobility.lazy and self.sim.mobility.movers:
+                dist = distance(self.pos, node.pos)
+            self.sim.deliver(*self.sim.arrivals([self.sim.link_delay(dist)], [node], self.now), pck)
+            return
+        delays, nodes = self.tx_links()
+        if nodes:
+            self.sim.deliver(*self.sim.arrivals(delays, nodes, self.now), pck)
+
+    ############################
+    def tx_links(self):
+        """Gets the nodes in transmission range with propagation delays of links. The lists are cached
+        until the neighbor list of node changes.
+
+           Args:
+
+           Returns:
+               Tuple(List of double,List of Node): Delays and nodes sorted by delay.
+        """
+        links = self._tx_links
+        if links is None:
+            link_delay = self.sim.link_delay
+            delays = []
+            nodes = []
+            for (dist, node) in self.neighbor_distance_list:
+                if dist > self.tx_range:
+                    break
+                delays.append(link_delay(dist))
+                nodes.append(node)
+            links = self._tx_links = (delays, nodes)
+        if self.sim.mobility.lazy and self.sim.mobility.movers:
+            # distances of moving nodes are updated only when links change, so links are sorted again
+            pos = self.pos
+            link_delay = self.sim.link_delay
+            pairs = sorted(((link_delay(distance(pos, node.pos)), node) for node in links[1]),
+                           key=itemgetter(0))
+            links = ([delay for (delay, node) in pairs], [node for (delay, node) in pairs])
+        return links
 
     ############################
     def set_timer(self, delay, callback, *args, **kwargs):
@@ -173,9 +610,7 @@ class BaseNode:
                timer: A Timer object
 
         """
-        timer = Timer(self.sim.env, delay, callback, *args, **kwargs)
-        self.timers.append(timer)
-        return timer
+        return Timer(self.sim.env, delay, callback, *args, registry=self.timers, **kwargs)
 
     ############################
     def kill_all_timers(self):
@@ -187,12 +622,13 @@ class BaseNode:
 
 
         """
-        for timer in self.timers:
+        for timer in list(self.timers):
             timer.kill()
 
     ############################
     def delayed_exec(self, delay, func, *args, **kwargs):
-        """Executes a function with given parameters after a given delay.
+        """Executes a function with given parameters after a given delay. If node fails before the delay
+        ends, the function is not executed.
 
            Args:
                 delay (double): Delay duration.
@@ -202,7 +638,14 @@ class BaseNode:
            Returns:
 
         """
-        return self.sim.delayed_exec(delay, func, *args, **kwargs)
+        if inspect.isgeneratorfunction(func):
+            return self.sim.delayed_exec(delay, func, *args, **kwargs)
+        return self.sim.delayed_exec(delay, self._call, self._incarnation, func, *args, **kwargs)
+
+    ############################
+    def _call(self, incarnation, func, *args, **kwargs):
+        if incarnation == self._incarnation:
+            func(*args, **kwargs)
 
     ############################
     def init(self):
@@ -228,37 +671,38 @@ class BaseNode:
         pass
 
     ###################
-    def move_step(self):
-        """Moves one step from the current position towards target position
+    def move(self, target_pos, speed):
+        """Changes the target position to given position. Node moves towards it with the mobility engine
+        of simulator and stops there.
+
+           Args:
+               target_pos (tuple of double): target position.
+               speed (double): speed
+.
+           Returns:
+         """
+        self.sim.mobility.move(self, target_pos, speed)
+
+    ###################
+    def follow(self, model):
+        """Makes node move by a mobility model such as RandomWaypoint or RandomDirection.
 
            Args:
+               model (object): Mobility model having a next_leg(node, rand) method.
 .
            Returns:
          """
-        step_size = config.SIM_MOVE_STEP_TIME * self.speed
-        if distance(self.pos, self.target_pos) <= step_size:
-            self.pos = self.target_pos
-        else:
-            target_ratio = step_size / distance(self.pos, self.target_pos)
-            self.pos = (self.pos[0] + (self.target_pos[0] - self.pos[0]) * target_ratio,
-                        self.pos[1] + (self.target_pos[1] - self.pos[1]) * target_ratio)
-        self.sim.update_neighbor_list(self.id)
-        if self.pos != self.target_pos:
-            self.delayed_exec(config.SIM_MOVE_STEP_TIME, self.move_step)
+        self.sim.mobility.follow(self, model)
 
     ###################
-    def move(self, target_pos, speed):
-        """Changes the target position to given position
+    def stop_moving(self):
+        """Stops node at its current position.
 
            Args:
-               target_pos (tuple of double): target position.
-               speed (double): speed
 .
            Returns:
          """
-        self.target_pos = target_pos
-        self.speed = speed
-        self.delayed_exec(config.SIM_MOVE_STEP_TIME, self.move_step)
+        self.sim.mobility.stop(self)
 
     ############################
     def on_receive(self, pck):
@@ -281,9 +725,58 @@ class BaseNode:
            Returns:
 
         """
-        if not self.is_sleeping:
+        if not self.is_sleeping and not self.is_failed:
+            if self._batch_receive:
+                if not self._inbox:
+                    self.sim.env.call_later(0, self._flush_inbox)
+                self._inbox.append(pck)
+            else:
+                self.on_receive(pck)
+
+    ############################
+    def on_receive_batch(self, pcks):
+        """It is executed with all packages received at the same time instead of on_receive().
+        It should be overridden if needed. By default, on_receive() is called for each package.
+
+           Args:
+                pcks (List of Dict): Packages received
+           Returns:
+
+        """
+        for pck in pcks:
             self.on_receive(pck)
 
+    ############################
+    def _flush_inbox(self):
+        pcks, self._inbox = self._inbox, []
+        if pcks:
+            self.on_receive_batch(pcks)
+
+    ############################
+    def on_neighbor_up(self, node):
+        """It is executed when an awake node comes in transmission range, or a node in transmission range
+        wakes up. It should be overridden if needed. Sleeping nodes are not notified. When a node wakes up,
+        it is notified of every awake node in its transmission range.
+
+           Args:
+                node (BaseNode): New neighbor
+           Returns:
+
+        """
+        pass
+
+    ############################
+    def on_neighbor_down(self, node):
+        """It is executed when a neighbor leaves transmission range or goes to sleep. It should be
+        overridden if needed.
+
+           Args:
+                node (BaseNode): Lost neighbor
+           Returns:
+
+        """
+        pass
+
     ############################
     def sleep(self):
         """Make node sleep. In sleeping node can not receive packages.
@@ -293,6 +786,9 @@ class BaseNode:
            Returns:
 
         """
+        if not self.is_sleeping:
+            self.sim._announce(self, False)
+            self.sim.sleeping += 1
         self.is_sleeping = True
 
     ############################
@@ -304,7 +800,33 @@ class BaseNode:
            Returns:
 
         """
+        was_sleeping = self.is_sleeping
         self.is_sleeping = False
+        if was_sleeping:
+            self.sim.sleeping -= 1
+            if self._deferred:
+                self._release_deferred()
+            self.sim._announce(self, True)
+
+    ############################
+    def _defer(self, time, pck):
+        """Keeps a package that is sent while node sleeps, in case node wakes up before it arrives."""
+        deferred = self._deferred
+        now = self.sim.env.now
+        while deferred and deferred[0][0] < now:
+            heapq.heappop(deferred)
+        heapq.heappush(deferred, (time, next(self.sim._deferred_count), pck))
+
+    ############################
+    def _release_deferred(self):
+        """Schedules the deferred packages that have not arrived yet when node wakes up. They are dropped if
+        node fails before they arrive."""
+        deferred, self._deferred = self._deferred, []
+        env = self.sim.env
+        now = env.now
+        for (time, count, pck) in deferred:
+            if time >= now:
+                env.call_at(time, self._call, self._incarnation, self.on_receive_check, pck)
 
     ############################
     def finish(self):
@@ -321,10 +843,11 @@ class BaseNode:
 ###########################################################
 class Timer(object):
     """
-    Class to model timers.
+    Class to model timers. A timer is a single entry in the event queue of
+    environment, so setting, killing and resetting it are cheap.
     """
 
-    def __init__(self, env, delay, callback, *args, **kwargs):
+    def __init__(self, env, delay, callback, *args, registry=None, **kwargs):
         self.env = env
         self.delay = delay
         self.action = None
@@ -332,73 +855,426 @@ class Timer(object):
         self.args = args
         self.kwargs = kwargs
         self.canceled = False
+        self.registry = registry
         self.set()
 
     def run(self):
         """
-        Calls a callback after time has elapsed.
+        Calls the callback when time has elapsed.
         """
-        try:
-            yield self.env.timeout(self.delay)
-            self.callback(*self.args, **self.kwargs)
-        except simpy.Interrupt as i:
-            self.canceled = True
+        self.action = None
+        if self.registry is not None:
+            self.registry.pop(self, None)
+        self.callback(*self.args, **self.kwargs)
 
     def set(self):
         """
         Starts the timer
         """
         if not self.action:
-            self.action = self.env.process(self.run())
+            self.canceled = False
+            self.action = self.env.call_later(self.delay, self.run)
+            if self.registry is not None:
+                self.registry[self] = None
 
     def kill(self):
         """
         Kills the timer
         """
         if self.action:
-            self.action.interrupt()
+            self.env.cancel(self.action)
             self.action = None
+            self.canceled = True
+            if self.registry is not None:
+                self.registry.pop(self, None)
 
     def reset(self):
         """
-        Interrupts the current timer and restarts.
+        Cancels the current timer and restarts.
         """
         self.kill()
         self.set()
 
 
+###########################################################
+class DutyCycle:
+    """Class to model a periodic sleep schedule shared by a group of nodes. Nodes are active in the
+    first active_fraction of every period and sleep in the rest. All nodes of a schedule are switched
+    by a single event.
+
+       Attributes:
+           sim (Simulator): Simulator of nodes.
+           period (double): Length of a cycle.
+           active_fraction (double): Fraction of period in which nodes are awake.
+           phase (double): Start time of the first cycle.
+           nodes (Dict of int to Node): Nodes following the schedule by their ids.
+           is_active (bool): If it is True, nodes are awake now.
+
+    """
+
+    ############################
+    def __init__(self, sim, period, active_fraction, phase=0):
+        """Constructor for DutyCycle class. It starts the schedule at the current time of simulation.
+
+           Args:
+               sim (Simulator): Simulator of nodes.
+               period (double): Length of a cycle.
+               active_fraction (double): Fraction of period in which nodes are awake.
+               phase (double): Start time of the first cycle.
+
+           Returns:
+               DutyCycle: Created DutyCycle object.
+        """
+        self.sim = sim
+        self.period = period
+        self.active_fraction = active_fraction
+        self.phase = phase
+        self.nodes = {}
+        self._cycle = math.floor((sim.now - phase) / period)
+        active_end = phase + (self._cycle + active_fraction) * period
+        self.is_active = sim.now < active_end
+        self._entry = None
+        if 0 < active_fraction < 1:
+            if self.is_active:
+                self._entry = sim.env.call_at(active_end, self._switch)
+            else:
+                self._cycle += 1
+                self._entry = sim.env.call_at(phase + self._cycle * period, self._switch)
+
+    ############################
+    def add(self, node):
+        """Adds a node to schedule and puts it in the current state of schedule.
+
+           Args:
+               node (BaseNode): Node to add.
+
+           Returns:
+
+        """
+        self.nodes[node.id] = node
+        node._duty_cycle = self
+        if self.is_active:
+            node.wake_up()
+        else:
+            node.sleep()
+
+    ############################
+    def remove(self, node):
+        """Removes a node from schedule. Node stays in its current state.
+
+           Args:
+               node (BaseNode): Node to remove.
+
+           Returns:
+
+        """
+        del self.nodes[node.id]
+        node._duty_cycle = None
+
+    ############################
+    def cancel(self):
+        """Stops the schedule.
+
+           Args:
+
+           Returns:
+
+        """
+        if self._entry is not None:
+            self.sim.env.cancel(self._entry)
+            self._entry = None
+
+    ############################
+    def _switch(self):
+        """Wakes up or puts to sleep all nodes, then schedules the next switch."""
+        self.is_active = not self.is_active
+        for node in list(self.nodes.values()):
+            if node.is_failed:
+                continue
+            if self.is_active:
+                node.wake_up()
+            else:
+                node.sleep()
+        if self.is_active:
+            next_time = self.phase + (self._cycle + self.active_fraction) * self.period
+        else:
+            self._cycle += 1
+            next_time = self.phase + self._cycle * self.period
+        self._entry = self.sim.env.call_at(next_time, self._switch)
+
+
+###########################################################
+class SpatialGrid:
+    """Uniform grid that indexes nodes by their positions to find nearby nodes quickly.
+
+       Attributes:
+           cell_size (double): Side length of a square cell. It should be close to the maximum transmission range.
+            If it is None, transmission range of the first inserted node is used, or 1 if it is 0.
+           cells (Dict of Tuple(int,int) to Dict of int to Node): Nodes in each occupied cell by their ids.
+           node_cells (Dict of int to Tuple(int,int)): Cell of each indexed node by its id.
+
+    """
+
+    ############################
+    def __init__(self, cell_size=None):
+        """Constructor for SpatialGrid class.
+
+           Args:
+               cell_size (double): Side length of a square cell.
+
+           Returns:
+               SpatialGrid: Created SpatialGrid object.
+        """
+        self.cell_size = cell_size
+        self.cells = {}
+        self.node_cells = {}
+
+    ############################
+    def cell_of(self, pos):
+        """Finds the cell of a position.
+
+           Args:
+               pos (Tuple(double,double)): Position.
+
+           Returns:
+               Tuple(int,int): Indices of the cell.
+        """
+        return (math.floor(pos[0] / self.cell_size), math.floor(pos[1] / self.cell_size))
+
+    ############################
+    def insert(self, node):
+        """Puts a node into the cell of its current position. If the node is already indexed, it is moved.
+
+           Args:
+               node (BaseNode): Node to index.
+
+           Returns:
+
+        """
+        if self.cell_size is None:
+            self.cell_size = node.tx_range if node.tx_range > 0 else 1.0
+        cell = self.cell_of(node.pos)
+        old_cell = self.node_cells.get(node.id)
+        if old_cell == cell:
+            return
+        if old_cell is not None:
+            self._discard(old_cell, node.id)
+        self.cells.setdefault(cell, {})[node.id] = node
+        self.node_cells[node.id] = cell
+
+    ############################
+    def remove(self, node):
+        """Removes a node from the index.
+
+           Args:
+               node (BaseNode): Node to remove.
+
+           Returns:
+
+        """
+        cell = self.node_cells.pop(node.id, None)
+        if cell is not None:
+            self._discard(cell, node.id)
+
+    ############################
+    def rebuild(self, cell_size):
+        """Changes the cell size and puts every indexed node into its new cell.
+
+           Args:
+               cell_size (double): Side length of a square cell.
+
+           Returns:
+
+        """
+        nodes = [node for members in self.cells.values() for node in members.values()]
+        self.cell_size = cell_size
+        self.cells = {}
+        self.node_cells = {}
+        for node in nodes:
+            self.insert(node)
+
+    ############################
+    def _discard(self, cell, id):
+        members = self.cells[cell]
+        del members[id]
+        if not members:
+            del self.cells[cell]
+
+    ############################
+    def nearby(self, pos, radius):
+        """Yields the nodes in the cells overlapping the square around a position. Some of them can be
+        farther than radius, so callers should check the exact distance.
+
+           Args:
+               pos (Tuple(double,double)): Center position.
+               radius (double): Search radius.
+
+           Returns:
+               Generator of BaseNode: Candidate nodes.
+        """
+        if self.cell_size is None:
+            return
+        cx, cy = self.cell_of(pos)
+        rings = math.ceil(radius / self.cell_size)
+        cells = self.cells
+        if (2 * rings + 1) ** 2 > len(cells):
+            for members in list(cells.values()):
+                yield from members.values()
+            return
+        for x in range(cx - rings, cx + rings + 1):
+            for y in range(cy - rings, cy + rings + 1):
+                members = cells.get((x, y))
+                if members:
+                    yield from members.values()
+
+
 ###########################################################
 class Simulator:
     """Class to model a network.
 
        Attributes:
-           env (simpy.rt.RealtimeEnvironment): Environment object in simpy
+           env (Environment): Environment object based on simpy. It is a RealtimeEnvironment in realtime mode.
            timescale (double): Seconds in real time for 1 second in simulation. It arranges speed of simulation
+           realtime (bool): If it is True, simulation time is synchronized with wall-clock time. Otherwise,
+            simulation runs as fast as possible.
            nodes (List of Node): Nodes in network.
            duration (double): Duration of simulation.
            random (Random): Random object to use.
            timeout (Function): Timeout Function.
+           grid (SpatialGrid): Spatial index of nodes used for neighbor discovery.
+           max_tx_range (double): The largest transmission range among nodes.
+           neighbor_margin (double): Extra distance beyond transmission range that neighbor lists cover.
+           link_delay (Function): Propagation delay of a link by its length, compiled from config.
+           arrivals (Function): Computes arrival times of a package sent at a time over links, sorted by time.
+           log_sink (LogSink): Sink of node outputs.
+           results (Dict of int to object): Values returned by finish() of nodes by node id, if not None.
+           config (SimConfig): Frozen settings of simulator.
+           params (Dict): Parameters of scenario the simulator is loaded from.
+           mobility (Mobility): Engine that moves nodes, StepMobility or AnalyticMobility by config.
+           sleeping (int): Number of sleeping nodes.
+           stop_condition (Function): Function checked while simulation runs. Simulation stops when it returns True.
+           check_interval (double): Simulation time between two checks of stop_condition.
+           end_time (double): Time at which the last run stopped.
+           stop_reason (string): Why the last run stopped, 'duration', 'idle', 'stopped' or 'condition'.
+           duty_cycles (Dict of Tuple(double,double,double) to DutyCycle): Sleep schedules by their period,
+            active fraction and phase.
 
     """
 
     ############################
-    def __init__(self, duration, timescale=1, seed=0):
+    def __init__(self, duration, timescale=1, seed=0, cell_size=None, neighbor_margin=0, realtime=True,
+                 log_sink=None, config=None):
         """Constructor for Simulator class.
 
            Args:
                until (double): Duration of simulation.
-               timescale (double): Seconds in real time for 1 second in simulation. It arranges speed of simulation
+               timescale (double): Seconds in real time for 1 second in simulation. It arranges speed of simulation.
+                If it is None, simulation runs as fast as possible.
                seed (double): seed for Random bbject.
+               cell_size (double): Cell size of the spatial index. If it is None, it follows the largest
+                transmission range and the index is rebuilt when that grows a lot.
+               neighbor_margin (double): Extra distance beyond transmission range that neighbor lists cover,
+                so that moving nodes are already known before they come in range.
+               realtime (bool): If it is False, a plain discrete-event environment is used and simulation
+                runs as fast as possible regardless of timescale.
+               log_sink (LogSink): Sink of node outputs. If it is None, outputs are written to terminal,
+                immediately in realtime mode and in batches otherwise.
+               config (SimConfig): Settings of simulator. It is frozen here. If it is None, settings are
+                taken from config module.
 
            Returns:
                Simulator: Created Simulator object.
         """
-        self.env = simpy.rt.RealtimeEnvironment(factor=timescale, strict=False)
+        self.realtime = realtime and timescale is not None
+        if self.realtime:
+            self.env = RealtimeEnvironment(factor=timescale, strict=False)
+        else:
+            self.env = Environment()
         self.nodes = []
         self.duration = duration
         self.timescale = timescale
         self.random = random.Random(seed)
         self.timeout = self.env.timeout
+        self.grid = SpatialGrid(cell_size)
+        self._fixed_cell_size = cell_size is not None
+        self.max_tx_range = 0
+        self.neighbor_margin = neighbor_margin
+        self.log_sink = log_sink if log_sink is not None else LogSink(buffer_size=1 if self.realtime else 1000)
+        self.results = {}
+        self.params = {}
+        self._started = False
+        self._neighbor_changes = []
+        self._neighbor_hooks = False
+        self._churn = {}
+        self.sleeping = 0
+        self._deferred_count = itertools.count()
+        self.duty_cycles = {}
+        self.stop_condition = None
+        self.check_interval = 0
+        self.end_time = None
+        self._condition_changed = False
+        self.stop_reason = None
+        self.config = (config if config is not None else SimConfig()).freeze()
+        if self.config.mobility_type == 'analytic':
+            self.mobility = AnalyticMobility(self)
+        else:
+            self.mobility = StepMobility(self, self.config.move_step_time)
+        self._compile_delay_policy()
+
+    ############################
+    @classmethod
+    def from_scenario(cls, path, classes=None, **kwargs):
+        """Creates a simulator from a scenario file. Each group of nodes is added with a single
+        add_nodes() call.
+
+           Args:
+               path (string): Path of scenario file.
+               classes (Dict of string to Class): Node classes by the names used in file. Names that are not
+                in it are imported as 'module:Class'.
+               **kwargs: Arguments of simulator overriding the ones in file.
+
+           Returns:
+               Simulator: Created Simulator object with nodes added.
+        """
+        data = scenario.load_scenario(path, classes)
+        settings = data['simulator']
+        settings.update(kwargs)
+        sim = cls(**settings)
+        sim.params = data['params']
+        for group in data['groups']:
+            sim.add_nodes(group['class'], group['positions'], group['tx_ranges'])
+        return sim
+
+    ############################
+    def _compile_delay_policy(self):
+        """Builds link_delay and arrivals functions once for the messaging delay type in config of simulator.
+
+           Args:
+
+           Returns:
+
+        """
+        delay_type = self.config.delay_type
+        if delay_type == 'random':
+            rand = self.random.random
+
+            def arrivals(delays, nodes, now):
+                times = [now + rand() for node in nodes]
+                order = sorted(range(len(nodes)), key=times.__getitem__)
+                return [times[i] for i in order], [nodes[i] for i in order]
+
+            self.link_delay = lambda dist: 0
+        else:
+            if delay_type == 'prop':
+                self.link_delay = lambda dist: dist / 3000000
+            else:
+                constant = self.config.constant_delay
+                self.link_delay = lambda dist: constant
+
+            def arrivals(delays, nodes, now):
+                return [now + delay for delay in delays], nodes
+
+        self.arrivals = arrivals
 
     ############################
     @property
@@ -414,7 +1290,8 @@ class Simulator:
 
     ############################
     def delayed_exec(self, delay, func, *args, **kwargs):
-        """Executes a function with given parameters after a given delay.
+        """Executes a function with given parameters after a given delay. Plain functions are put into the
+        lightweight event queue, generator functions are started as SimPy processes.
 
            Args:
                 delay (double): Delay duration.
@@ -424,8 +1301,53 @@ class Simulator:
            Returns:
 
         """
-        func = ensure_generator(self.env, func, *args, **kwargs)
-        start_delayed(self.env, func, delay=delay)
+        if inspect.isgeneratorfunction(func):
+            start_delayed(self.env, func(*args, **kwargs), delay=delay)
+            return None
+        if kwargs:
+            func = functools.partial(func, **kwargs)
+        return self.env.call_later(delay, func, *args)
+
+    ############################
+    def deliver(self, times, nodes, pck):
+        """Delivers a package to many nodes with a single event. The event calls on_receive_check() of the
+        nodes whose arrival time has come, then moves itself to the next arrival time. Sleeping nodes are
+        left out, they get the package only if they wake up before it arrives. Nodes that fail before it
+        arrives do not get it, even if they recover in the meantime.
+
+           Args:
+                times (List of double): Arrival times sorted in ascending order.
+                nodes (List of Node): Receiver node of each arrival.
+                pck (Dict): Package to deliver.
+           Returns:
+
+        """
+        if self.sleeping:
+            awake_times = []
+            awake_nodes = []
+            for (time, node) in zip(times, nodes):
+                if node.is_sleeping:
+                    node._defer(time, pck)
+                else:
+                    awake_times.append(time)
+                    awake_nodes.append(node)
+            if not awake_nodes:
+                return
+            times, nodes = awake_times, awake_nodes
+        incarnations = [node._incarnation for node in nodes]
+        self.env.call_at(times[0], self._deliver, times, nodes, incarnations, 0, pck)
+
+    ############################
+    def _deliver(self, times, nodes, incarnations, index, pck):
+        now = self.env.now
+        count = len(times)
+        while index < count and times[index] <= now:
+            node = nodes[index]
+            if node._incarnation == incarnations[index]:
+                node.on_receive_check(pck)
+            index += 1
+        if index < count:
+            self.env.call_at(times[index], self._deliver, times, nodes, incarnations, index, pck)
 
     ############################
     def add_node(self, node_class, pos, tx_range):
@@ -440,14 +1362,258 @@ class Simulator:
         id = len(self.nodes)
         node = node_class(self, id, pos, tx_range)
         self.nodes.append(node)
+        self.max_tx_range = max(self.max_tx_range, tx_range)
+        self._fit_grid()
         self.update_neighbor_list(id)
+        self.mobility.added([node])
         return node
 
+    ############################
+    def _fit_grid(self):
+        """Sets the cell size of the spatial index from the largest transmission range, unless it is given.
+        The index is rebuilt when the range grows beyond four cells, so that searches scan few cells."""
+        size = self.max_tx_range + self.neighbor_margin
+        if size <= 0:
+            size = 1.0
+        if self.grid.cell_size is None or (not self._fixed_cell_size and size > 4 * self.grid.cell_size):
+            self.grid.rebuild(size)
+
+    ############################
+    def add_nodes(self, node_class, positions, tx_ranges):
+        """Adds many nodes in to network at once. Links between nodes are found in a single vectorized
+        pass, then nodes are created. It is much faster than calling add_node() for each node.
+
+           Args:
+                node_class (Class): Node class inherited from Node.
+                positions (numpy.ndarray): Positions of nodes, an array with shape (N, 2).
+                tx_ranges (double or numpy.ndarray): Transmission range of all nodes or an array with shape (N,).
+           Returns:
+                List of nodeclass object: Created nodeclass objects
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        tx_ranges = np.broadcast_to(np.asarray(tx_ranges, dtype=float), (len(positions),))
+        if len(positions) == 0:
+            return []
+        # failed nodes are left out, so indices of links are positions in this list
+        nodes = [n for n in self.nodes if not n.is_failed]
+        first = len(nodes)
+        self.max_tx_range = max(self.max_tx_range, float(tx_ranges.max()))
+        self._fit_grid()
+        all_positions = np.concatenate([np.array([n.pos for n in nodes], dtype=float).reshape(-1, 2),
+                                        positions])
+        all_ranges = np.concatenate([np.array([n.tx_range for n in nodes], dtype=float), tx_ranges])
+        srcs, dsts, dists = neighbor_pairs(all_positions, all_ranges + self.neighbor_margin,
+                                           self.grid.cell_size, first)
+
+        new_nodes = [node_class(self, len(self.nodes) + i, tuple(pos), tx_range)
+                     for i, (pos, tx_range) in enumerate(zip(positions.tolist(), tx_ranges.tolist()))]
+        self.nodes.extend(new_nodes)
+        nodes.extend(new_nodes)
+        for node in new_nodes:
+            self.grid.insert(node)
+
+        # sort links by source, distance and destination as neighbor lists are sorted
+        ids = np.array([n.id for n in nodes], dtype=np.int64)
+        order = np.lexsort((dsts, dists, srcs))
+        dst_indices = dsts[order]
+        dst_ids = ids[dst_indices].tolist()
+        links = list(zip(dists[order].tolist(), map(nodes.__getitem__, dst_indices.tolist())))
+        for (src, start, end) in _group_bounds(srcs[order]):
+            node = nodes[src]
+            if src >= first:
+                node.neighbor_distance_list = links[start:end]
+                node.links = dict(zip(dst_ids[start:end], links[start:end]))
+            else:
+                for link in links[start:end]:
+                    bisect.insort(node.neighbor_distance_list, link)
+                    node.links[link[1].id] = link
+                    if self._started and node._neighbor_hooks and link[0] <= node.tx_range:
+                        self._neighbor_change(node, link[1], True)
+                node._tx_links = None
+
+        order = np.lexsort((srcs, dsts))
+        src_indices = srcs[order]
+        src_ids = ids[src_indices].tolist()
+        src_nodes = list(map(nodes.__getitem__, src_indices.tolist()))
+        for (dst, start, end) in _group_bounds(dsts[order]):
+            nodes[dst].in_neighbors.update(zip(src_ids[start:end], src_nodes[start:end]))
+        if self._started:
+            for node in new_nodes:
+                if node._neighbor_hooks:
+                    self._neighbor_diff(node, {}, node.links)
+        self.mobility.added(new_nodes)
+        return new_nodes
+
+    ############################
+    def fail_node(self, id):
+        """Crashes a node. Its timers and delayed calls are canceled, its run() process is stopped and it
+        stops moving. It is removed from neighbor lists of other nodes and packages on the way to it are
+        dropped. It takes time proportional to the number of neighbors.
+
+           Args:
+               id (int): Global unique id of node
+
+           Returns:
+
+        """
+        node = self.nodes[id]
+        if node.is_failed:
+            return
+        self.mobility.removed(node)
+        node.is_failed = True
+        node._incarnation += 1
+        node.kill_all_timers()
+        node._inbox = []
+        node._deferred = []
+        process = node._process
+        if process is not None and process.is_alive and process is not self.env.active_process:
+            process.interrupt()
+        node._process = None
+
+        for n in list(node.in_neighbors.values()):
+            self._unlink(n, node)
+        for (dist, n) in node.links.values():
+            del n.in_neighbors[id]
+        node.neighbor_distance_list = []
+        node.links = {}
+        node.in_neighbors = {}
+        node._tx_links = None
+        self.grid.remove(node)
+
+    ############################
+    def recover_node(self, id):
+        """Recovers a failed node at its position. Neighbor lists are updated, then init() and run() of
+        node are executed again if simulation is running. Neighbors of node are notified, but node itself
+        is not, it can read its neighbor list in init().
+
+           Args:
+               id (int): Global unique id of node
+
+           Returns:
+
+        """
+        node = self.nodes[id]
+        if node.is_removed:
+            raise ValueError(f'node {id} is removed and can not recover')
+        if not node.is_failed:
+            return
+        # node is still failed while its links are made, so it is not notified of its neighbors but they are
+        self.update_neighbor_list(id)
+        node.is_failed = False
+        self.mobility.added([node])
+        if node._duty_cycle is not None:
+            node._duty_cycle.add(node)
+        if self._started:
+            node.init()
+            node._process = self.env.process(_until_interrupted(ensure_generator(self.env, node.run)))
+
+    ############################
+    def remove_node(self, id):
+        """Removes a node from network permanently. It is failed and kept in nodes list with is_removed
+        flag, so that ids of other nodes do not change.
+
+           Args:
+               id (int): Global unique id of node
+
+           Returns:
+
+        """
+        entry = self._churn.pop(id, None)
+        if entry is not None:
+            self.env.cancel(entry)
+        self.fail_node(id)
+        self._leave_duty_cycle(self.nodes[id])
+        self.nodes[id].is_removed = True
+
+    ############################
+    def add_churn(self, mean_uptime, mean_downtime, ids=None):
+        """Fails and recovers nodes again and again. Times until a node fails and until it recovers are
+        drawn from exponential distributions with the random object of simulator.
+
+           Args:
+               mean_uptime (double): Mean time between recovery and next failure of a node.
+               mean_downtime (double): Mean time between failure and recovery of a node.
+               ids (Iterable of int): Ids of nodes. If it is None, all nodes are used.
+
+           Returns:
+
+        """
+        if ids is None:
+            ids = range(len(self.nodes))
+        for id in ids:
+            if not self.nodes[id].is_removed:
+                delay = self.random.expovariate(1 / mean_uptime)
+                self._churn[id] = self.env.call_later(delay, self._churn_step, id, mean_uptime, mean_downtime)
+
+    ############################
+    def _churn_step(self, id, mean_uptime, mean_downtime):
+        """Fails an active node or recovers a failed one, then schedules the next change."""
+        if self.nodes[id].is_failed:
+            self.recover_node(id)
+            delay = self.random.expovariate(1 / mean_uptime)
+        else:
+            self.fail_node(id)
+            delay = self.random.expovariate(1 / mean_downtime)
+        self._churn[id] = self.env.call_later(delay, self._churn_step, id, mean_uptime, mean_downtime)
+
+    ############################
+    def set_duty_cycle(self, ids, period, active_fraction, phase=0):
+        """Makes nodes sleep and wake up periodically. Nodes are awake in the first active_fraction of every
+        period starting from phase. Nodes with the same schedule share a DutyCycle, which switches all of
+        them with a single event.
+
+           Args:
+               ids (Iterable of int): Ids of nodes.
+               period (double): Length of a cycle.
+               active_fraction (double): Fraction of period in which nodes are awake.
+               phase (double): Start time of the first cycle.
+
+           Returns:
+               DutyCycle: Schedule of nodes.
+        """
+        key = (period, active_fraction, phase)
+        schedule = self.duty_cycles.get(key)
+        if schedule is None:
+            schedule = self.duty_cycles[key] = DutyCycle(self, period, active_fraction, phase)
+        for id in ids:
+            node = self.nodes[id]
+            if node._duty_cycle is not schedule:
+                self._leave_duty_cycle(node)
+                schedule.add(node)
+        return schedule
+
+    ############################
+    def clear_duty_cycle(self, ids):
+        """Removes nodes from their sleep schedules and wakes them up.
+
+           Args:
+               ids (Iterable of int): Ids of nodes.
+
+           Returns:
+
+        """
+        for id in ids:
+            node = self.nodes[id]
+            self._leave_duty_cycle(node)
+            node.wake_up()
+
+    ############################
+    def _leave_duty_cycle(self, node):
+        """Removes a node from its schedule and stops the schedule if no node is left."""
+        schedule = node._duty_cycle
+        if schedule is None:
+            return
+        schedule.remove(node)
+        if not schedule.nodes:
+            schedule.cancel()
+            del self.duty_cycles[(schedule.period, schedule.active_fraction, schedule.phase)]
+
     ############################
     def update_neighbor_list(self, id):
         '''
-        Maintain each node's neighbor list by sorted distance after affected
-        by addition or relocation of node with ID id
+        Maintain neighbor lists sorted by distance after addition or relocation of node with ID id.
+        Only the nodes in the grid cells around the node are visited, and only the entries of this
+        node are added, moved or removed in other nodes' lists.
 
         Args:
             id (int): Global unique id of node
@@ -455,44 +1621,320 @@ class Simulator:
 
         '''
         me = self.nodes[id]
+        self.grid.insert(me)
+        self._refresh_neighbors(me)
 
-        # (re)sort other nodes' neighbor lists by distance
-        for n in self.nodes:
-            # skip this node
+    ############################
+    def _refresh_neighbors(self, me):
+        """Rebuilds neighbor list of a node that is already at its place in the spatial index, and its
+        entries in other nodes' lists."""
+        id = me.id
+        margin = self.neighbor_margin
+        old_links = me.links
+        old_in_neighbors = me.in_neighbors
+        mylist = []
+        links = {}
+        in_neighbors = {}
+        for n in itertools.chain(self.grid.nearby(me.pos, self.max_tx_range + margin),
+                                 self.mobility.unindexed()):
             if n is me:
                 continue
+            dist = distance(n.pos, me.pos)
+            if dist <= me.tx_range + margin:
+                link = (dist, n)
+                mylist.append(link)
+                links[n.id] = link
+                n.in_neighbors[id] = me
+            if dist <= n.tx_range + margin:
+                self._link(n, me, dist)
+                in_neighbors[n.id] = n
+
+        # forget the nodes that are out of range now
+        for n in old_in_neighbors.values():
+            if n.id not in in_neighbors:
+                self._unlink(n, me)
+        for (dist, n) in old_links.values():
+            if n.id not in links:
+                del n.in_neighbors[id]
+        mylist.sort()
+        me.neighbor_distance_list = mylist
+        if me._neighbor_hooks:
+            self._neighbor_diff(me, old_links, links)
+        me.links = links
+        me._tx_links = None
+        me.in_neighbors = in_neighbors
 
-            nlist = n.neighbor_distance_list
+    ############################
+    def update_neighbor_lists(self, ids):
+        """Maintains neighbor lists after many nodes are relocated at once. All of them are moved in the
+        spatial index first, so that each one finds the others at their new positions. If a large part of
+        network is relocated, links of all relocated nodes are found in a single vectorized pass.
 
-            # remove this node from other nodes' neighbor lists
-            for i, (dist, neighbor) in enumerate(nlist):
-                if neighbor is me:
-                    del nlist[i]
-                    break
+           Args:
+               ids (List of int): Global unique ids of relocated nodes, without repetition.
+
+           Returns:
+
+        """
+        nodes = self.nodes
+        movers = [nodes[id] for id in ids]
+        for me in movers:
+            self.grid.insert(me)
+        if len(movers) * 16 < len(nodes):
+            for me in movers:
+                self._refresh_neighbors(me)
+            return
+
+        # relocated nodes are put at the end, so that only the links touching them are found
+        moved = set(ids)
+        order = [n for n in nodes if n.id not in moved and not n.is_failed]
+        first = len(order)
+        order.extend(movers)
+        positions = np.array([n.pos for n in order], dtype=float)
+        tx_ranges = np.array([n.tx_range for n in order], dtype=float) + self.neighbor_margin
+        srcs, dsts, dists = neighbor_pairs(positions, tx_ranges, self.grid.cell_size, first)
+
+        lists = {id: [] for id in ids}
+        links = {id: {} for id in ids}
+        in_neighbors = {id: {} for id in ids}
+        for (s, d, dist) in zip(srcs.tolist(), dsts.tolist(), dists.tolist()):
+            src = order[s]
+            dst = order[d]
+            if d >= first:
+                in_neighbors[dst.id][src.id] = src
+            if s >= first:
+                link = (dist, dst)
+                lists[src.id].append(link)
+                links[src.id][dst.id] = link
+                if d < first:
+                    dst.in_neighbors[src.id] = src
+            else:
+                self._link(src, dst, dist)
+
+        # forget the nodes that are out of range now, relocated ones are rebuilt below
+        for me in movers:
+            new_in = in_neighbors[me.id]
+            for n in me.in_neighbors.values():
+                if n.id not in new_in and n.id not in moved:
+                    self._unlink(n, me)
+            new_links = links[me.id]
+            for (dist, n) in me.links.values():
+                if n.id not in new_links and n.id not in moved:
+                    del n.in_neighbors[me.id]
+        for me in movers:
+            mylist = lists[me.id]
+            mylist.sort()
+            me.neighbor_distance_list = mylist
+            if me._neighbor_hooks:
+                self._neighbor_diff(me, me.links, links[me.id])
+            me.links = links[me.id]
+            me._tx_links = None
+            me.in_neighbors = in_neighbors[me.id]
+
+    ############################
+    def _set_link(self, src, dst, dist):
+        """Adds, updates or removes the entry of dst in neighbor list of src.
+
+           Args:
+               src (BaseNode): Node whose neighbor list changes.
+               dst (BaseNode): Neighbor node.
+               dist (double): Distance between nodes. If it is None, the entry is removed.
+
+           Returns:
+
+        """
+        if dist is not None:
+            self._link(src, dst, dist)
+            dst.in_neighbors[src.id] = src
+        elif dst.id in src.links:
+            self._unlink(src, dst)
+            del dst.in_neighbors[src.id]
+
+    ############################
+    def _link(self, node, neighbor, dist):
+        """Inserts or updates the entry of neighbor in node's sorted neighbor list."""
+        nlist = node.neighbor_distance_list
+        old = node.links.get(neighbor.id)
+        if old is not None:
+            if old[0] == dist:
+                return
+            del nlist[bisect.bisect_left(nlist, old)]
+        link = (dist, neighbor)
+        bisect.insort(nlist, link)
+        node.links[neighbor.id] = link
+        node._tx_links = None
+        if node._neighbor_hooks and (old is not None and old[0] <= node.tx_range) != (dist <= node.tx_range):
+            self._neighbor_change(node, neighbor, dist <= node.tx_range)
+
+    ############################
+    def _unlink(self, node, neighbor):
+        """Removes the entry of neighbor from node's sorted neighbor list."""
+        nlist = node.neighbor_distance_list
+        link = node.links.pop(neighbor.id)
+        del nlist[bisect.bisect_left(nlist, link)]
+        node._tx_links = None
+        if node._neighbor_hooks and link[0] <= node.tx_range:
+            self._neighbor_change(node, neighbor, False)
+
+    ############################
+    def _neighbor_diff(self, node, old_links, links):
+        """Notifies a node of the neighbors that come in or go out of its transmission range between
+        two versions of its links."""
+        tx_range = node.tx_range
+        for (dist, n) in links.values():
+            if dist <= tx_range:
+                old = old_links.get(n.id)
+                if old is None or old[0] > tx_range:
+                    self._neighbor_change(node, n, True)
+        for (dist, n) in old_links.values():
+            if dist <= tx_range:
+                new = links.get(n.id)
+                if new is None or new[0] > tx_range:
+                    self._neighbor_change(node, n, False)
+
+    ############################
+    def _announce(self, node, up):
+        """Notifies the nodes having a node in transmission range that it wakes up or goes to sleep.
+        A node that wakes up is also notified of its awake neighbors."""
+        if not self._neighbor_hooks or not self._started:
+            return
+        for n in node.in_neighbors.values():
+            if n._neighbor_hooks and n.links[node.id][0] <= n.tx_range:
+                self._neighbor_change(n, node, up)
+        if up and node._neighbor_hooks:
+            for n in node.tx_links()[1]:
+                self._neighbor_change(node, n, True)
 
-            # then insert it while maintaining sort order by distance
-            bisect.insort(nlist, (distance(n.pos, me.pos), me))
+    ############################
+    def _neighbor_change(self, node, neighbor, up):
+        """Queues a neighbor notification of node. Notifications are delivered together with a zero delay
+        event, after neighbor lists are consistent again."""
+        if not self._started or node.is_sleeping or node.is_failed or neighbor.is_sleeping:
+            return
+        if not self._neighbor_changes:
+            self.env.call_later(0, self._notify_neighbors)
+        self._neighbor_changes.append((node, neighbor, up))
 
-        self.nodes[id].neighbor_distance_list = [
-            (distance(n.pos, me.pos), n)
-            for n in self.nodes if n is not me
-        ]
-        self.nodes[id].neighbor_distance_list.sort()
+    ############################
+    def _notify_neighbors(self):
+        changes, self._neighbor_changes = self._neighbor_changes, []
+        for (node, neighbor, up) in changes:
+            if node.is_sleeping or node.is_failed:
+                continue
+            if up:
+                node.on_neighbor_up(neighbor)
+            else:
+                node.on_neighbor_down(neighbor)
 
     ############################
     def run(self):
         """Runs the simulation. It initialize every node, then executes each nodes run function.
-        Finally calls finish functions of nodes.
+        Simulation stops at duration, or earlier when no events remain, stop() is called or stop_condition
+        returns True. Finally calls finish functions of nodes and keeps their returned values in results.
+
+           Args:
+
+           Returns:
+               double: Time at which simulation stopped.
+        """
+        # buffered log lines are written even if a node raises an exception
+        try:
+            active = [n for n in self.nodes if not n.is_failed]
+            for n in active:
+                n.init()
+            self._started = True
+            for n in active:
+                n._process = self.env.process(_until_interrupted(ensure_generator(self.env, n.run)))
+            self.stop_reason = 'stopped'
+            self._condition_changed = True
+            # processing is resumed when stop_when() is called during the run, to check the new condition
+            while self.stop_reason == 'stopped' and self._condition_changed:
+                self._condition_changed = False
+                self.stop_reason = self.env.run_events(self.duration, self.stop_condition, self.check_interval)
+            self.end_time = self.now
+            for n in self.nodes:
+                result = n.finish()
+                if result is not None:
+                    self.results[n.id] = result
+        finally:
+            self.log_sink.flush()
+        return self.end_time
+
+    ############################
+    def stop(self):
+        """Stops the simulation after the events of the current time. finish() of nodes are called as usual.
 
            Args:
 
            Returns:
 
         """
+        self.env.stop()
+
+    ############################
+    def stop_when(self, condition, check_interval=0):
+        """Sets a function to stop the simulation when it returns True, e.g. when an algorithm converges.
+        It is called after events at most once every check_interval of simulation time. It can also be
+        called while simulation runs, e.g. from run() of a node, then it is used from the current time on.
+
+           Args:
+               condition (Function): Function without arguments returning bool.
+               check_interval (double): Simulation time between two checks. If it is 0, it is checked after
+                every event.
+
+           Returns:
+
+        """
+        self.stop_condition = condition
+        self.check_interval = check_interval
+        if self._started and self.end_time is None:
+            self.env.call_at(self.now, self._change_condition)
+
+    ############################
+    def _change_condition(self):
+        """Makes run_events() return, so that run() starts it again with the new stop condition."""
+        self._condition_changed = True
+        raise StopSimulation('condition changed')
+
+    ############################
+    def adjacency(self, awake_only=False):
+        """Builds the connectivity graph of network as a compressed sparse row structure. A link (i, j)
+        exists if node j is in transmission range of node i. Links are found in a single vectorized pass
+        over the spatial grid. Failed nodes have no links; functions in source/topology.py can analyse it.
+
+           Args:
+               awake_only (bool): If it is True, sleeping nodes have no links either.
+
+           Returns:
+               Tuple(numpy.ndarray,numpy.ndarray,numpy.ndarray): indptr, indices and distances. Out-links of
+               node i are indices[indptr[i]:indptr[i + 1]] sorted by distance, and distances keeps their
+               lengths.
+        """
+        count = len(self.nodes)
+        ids = np.array([n.id for n in self.nodes
+                        if not n.is_failed and not (awake_only and n.is_sleeping)], dtype=np.int64)
+        positions = np.array([self.nodes[id].pos for id in ids.tolist()], dtype=float).reshape(-1, 2)
+        tx_ranges = np.array([self.nodes[id].tx_range for id in ids.tolist()], dtype=float)
+        cell_size = self.grid.cell_size or (float(tx_ranges.max()) if len(ids) else 1)
+        srcs, dsts, dists = neighbor_pairs(positions, tx_ranges, cell_size)
+        srcs = ids[srcs]
+        dsts = ids[dsts]
+        order = np.lexsort((dsts, dists, srcs))
+        indptr = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(srcs, minlength=count), out=indptr[1:])
+        return indptr, dsts[order], dists[order]
+
+    ############################
+    def log_only(self, ids):
+        """Enables logging only for the given nodes. Outputs of the other nodes are dropped before they
+        reach the log sink.
+
+           Args:
+               ids (Iterable of int): Ids of nodes to log.
+
+           Returns:
+
+        """
+        ids = set(ids)
         for n in self.nodes:
-            n.init()
-        for n in self.nodes:
-            self.env.process(ensure_generator(self.env, n.run))
-        self.env.run(until=self.duration)
-        for n in self.nodes:
-            n.finish()
+            n.logging = n.id in ids
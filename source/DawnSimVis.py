@@ -2,8 +2,10 @@
 """
 from source import DawnSim
 from source.DawnSim import *
+import itertools
 from threading import Thread
 from topovis import Scene
+from topovis.common import DEFAULT
 from topovis.TkPlotter import Plotter
 
 
@@ -15,6 +17,10 @@ class BaseNode(DawnSim.BaseNode):
 
     """
 
+    EFFECT_TIME = 0.2
+    """double: Time that a transmission circle or a unicast arrow stays visible.
+    """
+
     ###################
     def __init__(self, sim, id, pos, tx_range):
         """Constructor for visualised Node class. Creates a node in topovis scene.
@@ -31,6 +37,7 @@ class BaseNode(DawnSim.BaseNode):
         super().__init__(sim, id, pos, tx_range)
         self.scene = self.sim.scene
         self.scene.node(id, *pos)
+        self._effects = {}
 
     ###################
     def send(self, dest, pck):
@@ -43,33 +50,39 @@ class BaseNode(DawnSim.BaseNode):
            Returns:
 
         """
-        obj_id = self.scene.circle(
-            self.pos[0], self.pos[1],
-            self.tx_range,
-            line="wsnsimpy:tx")
+        pos = self.pos
+        if self._show_effect(f"tx{self.id}"):
+            self.scene.circle(pos[0], pos[1], self.tx_range, id=f"tx{self.id}", line="wsnsimpy:tx")
         super().send(dest, pck)
-        self.delayed_exec(0.2, self.scene.delshape, obj_id)
 
         if not dest == DawnSim.BROADCAST_ADDR:
             destPos = self.sim.nodes[dest].pos
-            if distance(self.pos, destPos) <= self.tx_range:
-                obj_id = self.scene.line(
-                    self.pos[0], self.pos[1],
-                    destPos[0], destPos[1],
-                    line="wsnsimpy:unicast")
-                self.delayed_exec(0.2,self.scene.delshape,obj_id)
+            if distance(pos, destPos) <= self.tx_range and self._show_effect(f"uc{self.id}-{dest}"):
+                self.scene.line(pos[0], pos[1], destPos[0], destPos[1], id=f"uc{self.id}-{dest}",
+                                line="wsnsimpy:unicast")
 
     ###################
-    def move_step(self):
-        """Visualise move process in addition to base move method.
+    def _show_effect(self, shape_id):
+        """Reserves a shape of node for EFFECT_TIME and schedules hiding it. Shapes are hidden instead of
+        deleted, so that the plotter reuses their canvas items. Returns False if too many effects are visible."""
+        sim = self.sim
+        if shape_id not in self._effects:
+            if sim.visible_effects >= sim.max_effects:
+                return False
+            sim.visible_effects += 1
+        generation = next(sim._effect_generations)
+        self._effects[shape_id] = generation
+        sim.delayed_exec(self.EFFECT_TIME, self._hide_effect, shape_id, generation)
+        return True
 
-           Args:
-
-           Returns:
-
-        """
-        super().move_step()
-        self.scene.nodemove(self.id, self.pos[0], self.pos[1])
+    ###################
+    def _hide_effect(self, shape_id, generation):
+        """Hides a shape unless it has been shown again after this call is scheduled."""
+        if self._effects.get(shape_id) != generation:
+            return
+        del self._effects[shape_id]
+        self.sim.visible_effects -= 1
+        self.scene.hideshape(shape_id)
 
     ###################
     def sleep(self):
@@ -80,11 +93,14 @@ class BaseNode(DawnSim.BaseNode):
            Returns:
 
         """
+        if self.is_sleeping:
+            return
+        links = self.scene.links
         for (dist, node) in self.neighbor_distance_list:
-            if dist <= self.tx_range:
-                self.scene.dellink(self.id, node.id, "edge")
-            else:
+            if dist > self.tx_range:
                 break
+            if (min(self.id, node.id), max(self.id, node.id), "edge") in links:
+                self.scene.dellink(self.id, node.id, "edge")
         self.change_color(0.9411, 0.9411, 0.9411)
         super().sleep()
 
@@ -105,6 +121,8 @@ class BaseNode(DawnSim.BaseNode):
 
 ###########################################################
 class _FakeScene:
+    links = frozenset()
+
     def _fake_method(self, *args, **kwargs):
         pass
 
@@ -123,9 +141,12 @@ class Simulator(DawnSim.Simulator):
     Attributes:
         visual (bool): A flag to visualising process.
         terrain_size (Tuple(double,double)): Size of visualised terrain.
+        max_effects (int): Maximum number of transmission circles and unicast arrows visible at once.
+        visible_effects (int): Number of transmission circles and unicast arrows visible now.
     '''
 
-    def __init__(self, duration, timescale=1, seed=0, terrain_size=(650, 650), visual=True, title=None):
+    def __init__(self, duration, timescale=1, seed=0, terrain_size=(650, 650), visual=True, title=None,
+                 realtime=True, config=None, fps=30, max_effects=200):
         """Constructor for visualised Simulator class.
 
            Args:
@@ -135,13 +156,22 @@ class Simulator(DawnSim.Simulator):
                terrain_size (Tuple(double,double)): Size of visualised terrain.
                visual (bool): A flag to visualising process.
                title (string): Title of scene.
+               realtime (bool): If it is False, simulation runs as fast as possible. It is useful only
+                when visual is False.
+               config (SimConfig): Settings of simulator. If it is None, settings are taken from config module.
+               fps (double): Maximum number of frames drawn in a second.
+               max_effects (int): Maximum number of transmission circles and unicast arrows visible at once.
 
            Returns:
                Simulator: Created Simulator object.
         """
-        super().__init__(duration, timescale, seed)
+        super().__init__(duration, timescale, seed, realtime=realtime, config=config)
         self.visual = visual
         self.terrain_size = terrain_size
+        self._colors = {}
+        self.max_effects = max_effects
+        self.visible_effects = 0
+        self._effect_generations = itertools.count()
         if self.visual:
             self.scene = Scene(realtime=True)
             self.scene.linestyle("wsnsimpy:tx", color=(0, 0, 1), dash=(5, 5))
@@ -152,7 +182,7 @@ class Simulator(DawnSim.Simulator):
             self.scene.linestyle("edge", color=(.7,.7,.7), width=1)
             if title is None:
                 title = "WsnSimPy"
-            self.tkplot = Plotter(windowTitle=title, terrain_size=terrain_size)
+            self.tkplot = Plotter(windowTitle=title, terrain_size=terrain_size, fps=fps)
             self.tk = self.tkplot.tk
             self.scene.addPlotter(self.tkplot)
             self.scene.init(*terrain_size)
@@ -168,31 +198,140 @@ class Simulator(DawnSim.Simulator):
         """
         while True:
             self.scene.setTime(self.now)
+            if self.mobility.lazy:
+                for node in self.mobility.movers:
+                    pos = node.pos
+                    self.scene.nodemove(node.id, pos[0], pos[1])
             yield self.timeout(0.1)
 
     def update_neighbor_list(self, id):
-        """Updates edges in scene.
+        """Moves node and updates its edges in scene. Only the edges that appear or disappear are added or
+        deleted; the others are redrawn at the new position by the plotter.
 
            Args:
                id (int): Global unique id of node
            Returns:
         """
-        node1 = self.nodes[id]
-        for (dist, node2) in node1.neighbor_distance_list:
-            if dist <= node1.tx_range:
-                try:
-                   self.scene.dellink(id, node2.id, "edge")
-                except:
-                    pass
-            else:
-                break
+        if not self.visual:
+            super().update_neighbor_list(id)
+            return
+        node = self.nodes[id]
+        self.scene.nodemove(id, node.pos[0], node.pos[1])
+        before = self._edge_candidates(node)
         super().update_neighbor_list(id)
-        for (dist, node2) in node1.neighbor_distance_list:
-            if dist <= node1.tx_range:
-                self.scene.addlink(id, node2.id, "edge")
-            else:
-                break
+        self._sync_edges(node, before)
+
+    def update_neighbor_lists(self, ids):
+        """Moves relocated nodes and updates their edges in scene. Only the edges that appear or disappear
+        are added or deleted.
+
+           Args:
+               ids (List of int): Global unique ids of relocated nodes.
+           Returns:
+        """
+        if not self.visual:
+            super().update_neighbor_lists(ids)
+            return
+        before = {}
+        for id in ids:
+            node = self.nodes[id]
+            self.scene.nodemove(id, node.pos[0], node.pos[1])
+            before[id] = self._edge_candidates(node)
+        super().update_neighbor_lists(ids)
+        for id in ids:
+            self._sync_edges(self.nodes[id], before[id])
+
+    def fail_node(self, id):
+        """Removes edges of node from scene and paints it gray in addition to failing it.
 
+           Args:
+               id (int): Global unique id of node
+           Returns:
+        """
+        node = self.nodes[id]
+        if self.visual and not node.is_failed:
+            for other in set(node.links) | set(node.in_neighbors):
+                if (min(id, other), max(id, other), "edge") in self.scene.links:
+                    self.scene.dellink(id, other, "edge")
+            color = self.scene.nodes[id].color
+            self._colors[id] = color if color != DEFAULT else (0, 0, 0)
+            self.scene.nodecolor(id, 0.5, 0.5, 0.5)
+        super().fail_node(id)
+
+    def recover_node(self, id):
+        """Restores color of node in addition to recovering it.
+
+           Args:
+               id (int): Global unique id of node
+           Returns:
+        """
+        super().recover_node(id)
+        if id in self._colors:
+            self.scene.nodecolor(id, *self._colors.pop(id))
+
+    def _set_link(self, src, dst, dist):
+        """Updates the edge between two nodes in scene when none of them is in transmission range of the
+        other anymore, or one of them comes in range.
+
+           Args:
+               src (BaseNode): Node whose neighbor list changes.
+               dst (BaseNode): Neighbor node.
+               dist (double): Distance between nodes. If it is None, the entry is removed.
+           Returns:
+        """
+        super()._set_link(src, dst, dist)
+        reverse = dst.links.get(src.id)
+        in_range = (dist is not None and dist <= src.tx_range) or (reverse is not None and reverse[0] <= dst.tx_range)
+        drawn = (min(src.id, dst.id), max(src.id, dst.id), "edge") in self.scene.links
+        if drawn and not in_range:
+            self.scene.dellink(src.id, dst.id, "edge")
+        elif in_range and not drawn:
+            self.scene.addlink(src.id, dst.id, "edge")
+
+    def _edge_candidates(self, node):
+        """Gets ids of nodes that may have an edge with node."""
+        return set(node.links) | set(node.in_neighbors)
+
+    def _sync_edges(self, node, before):
+        """Adds and deletes edges of node in scene, so that there is an edge between node and every node
+        in transmission range of it or having it in transmission range."""
+        links = self.scene.links
+        id = node.id
+        for other in before | self._edge_candidates(node):
+            link = node.links.get(other)
+            reverse = self.nodes[other].links.get(id)
+            in_range = (link is not None and link[0] <= node.tx_range) or \
+                       (reverse is not None and reverse[0] <= self.nodes[other].tx_range)
+            drawn = (min(id, other), max(id, other), "edge") in links
+            if drawn and not in_range:
+                self.scene.dellink(id, other, "edge")
+            elif in_range and not drawn:
+                self.scene.addlink(id, other, "edge")
+
+    def add_nodes(self, node_class, positions, tx_ranges):
+        """Adds many nodes at once and draws all of their edges with a single scene command. Edges are
+        drawn for nodes in range of a new node and for nodes having a new node in range.
+
+           Args:
+                node_class (Class): Node class inherited from Node.
+                positions (numpy.ndarray): Positions of nodes, an array with shape (N, 2).
+                tx_ranges (double or numpy.ndarray): Transmission range of all nodes or an array with shape (N,).
+           Returns:
+                List of nodeclass object: Created nodeclass objects
+        """
+        nodes = super().add_nodes(node_class, positions, tx_ranges)
+        edges = set()
+        for node1 in nodes:
+            for (dist, node2) in node1.neighbor_distance_list:
+                if dist > node1.tx_range:
+                    break
+                edges.add((min(node1.id, node2.id), max(node1.id, node2.id)))
+            # existing nodes may have new nodes in range that are out of range of them
+            for n in node1.in_neighbors.values():
+                if n.links[node1.id][0] <= n.tx_range:
+                    edges.add((min(node1.id, n.id), max(node1.id, n.id)))
+        self.scene.addlinks(sorted(edges), "edge")
+        return nodes
 
     def run(self):
         """Starts visualisation process. Puts base run method to a Thread so that visualisation become main process.
@@ -6,4 +6,84 @@ BROADCAST_ADDR = -1
 SIM_MESSAGGING_DELAY_TYPE = 'prop'  # could be 'prop', 'random', or 'constant'
 SIM_MESSAGGING_CONSTANT_DELAY = 1  # if the delay type is constant, it will be used as delay
 SIM_MOVE_STEP_TIME = 0.1  # step time of moving
+SIM_MOBILITY_TYPE = 'step'  # could be 'step' or 'analytic'
 
+
+
+###########################################################
+class SimConfig:
+    """Class to keep the settings of a single simulator. Settings that are not given are taken from the
+    module properties above at the time of creation. Simulator freezes its config, then it can not be
+    changed, so that hot-path functions built from it stay valid.
+
+       Attributes:
+           delay_type (string): Messaging delay type, 'prop', 'random', or 'constant'.
+           constant_delay (double): Delay used if delay type is constant.
+           move_step_time (double): Step time of moving.
+           mobility_type (string): Mobility engine, 'step' or 'analytic'.
+
+    """
+
+    DELAY_TYPES = ('prop', 'random', 'constant')
+    MOBILITY_TYPES = ('step', 'analytic')
+
+    ############################
+    def __init__(self, delay_type=None, constant_delay=None, move_step_time=None, mobility_type=None):
+        """Constructor for SimConfig class.
+
+           Args:
+               delay_type (string): Messaging delay type, 'prop', 'random', or 'constant'.
+               constant_delay (double): Delay used if delay type is constant.
+               move_step_time (double): Step time of moving.
+               mobility_type (string): Mobility engine, 'step' or 'analytic'.
+
+           Returns:
+               SimConfig: Created SimConfig object.
+        """
+        self._frozen = False
+        self.delay_type = SIM_MESSAGGING_DELAY_TYPE if delay_type is None else delay_type
+        self.constant_delay = SIM_MESSAGGING_CONSTANT_DELAY if constant_delay is None else constant_delay
+        self.move_step_time = SIM_MOVE_STEP_TIME if move_step_time is None else move_step_time
+        self.mobility_type = SIM_MOBILITY_TYPE if mobility_type is None else mobility_type
+        if self.delay_type not in self.DELAY_TYPES:
+            raise ValueError(f'unknown delay type {self.delay_type!r}')
+        if self.mobility_type not in self.MOBILITY_TYPES:
+            raise ValueError(f'unknown mobility type {self.mobility_type!r}')
+
+    ############################
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f'config is frozen, use replace() to change {name}')
+        object.__setattr__(self, name, value)
+
+    ############################
+    def __repr__(self):
+        return (f'SimConfig(delay_type={self.delay_type!r}, constant_delay={self.constant_delay!r}, '
+                f'move_step_time={self.move_step_time!r}, mobility_type={self.mobility_type!r})')
+
+    ############################
+    def freeze(self):
+        """Makes config read-only.
+
+           Args:
+
+           Returns:
+               SimConfig: Config itself.
+        """
+        self._frozen = True
+        return self
+
+    ############################
+    def replace(self, **changes):
+        """Creates a new config with some settings changed.
+
+           Args:
+               **changes: Settings to change.
+
+           Returns:
+               SimConfig: Created SimConfig object, not frozen.
+        """
+        settings = {'delay_type': self.delay_type, 'constant_delay': self.constant_delay,
+                    'move_step_time': self.move_step_time, 'mobility_type': self.mobility_type}
+        settings.update(changes)
+        return SimConfig(**settings)
@@ -0,0 +1,173 @@
+"""Buffered log sink for node outputs.
+"""
+
+import collections
+import queue
+import sys
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = float('inf')
+"""Log levels. A sink with level OFF drops every record.
+"""
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+
+###########################################################
+def format_record(record):
+    """Formats a log record as a line of text. Message is formatted with its args only here, so that
+    records which are never written are never formatted.
+
+       Args:
+           record (Tuple(double,int,int,string,string,Tuple)): Time, node id, level, category, message and
+            message args.
+
+       Returns:
+           string: Formatted line.
+    """
+    (time, id, level, category, msg, args) = record
+    if args:
+        msg = msg % args
+    if level != INFO:
+        msg = f"{LEVEL_NAMES.get(level, level)}: {msg}"
+    if category is not None:
+        msg = f"<{category}> {msg}"
+    return f"Node {'#' + str(id):4}[{time:10.5f}] {msg}"
+
+
+###########################################################
+class LogSink:
+    """Class to collect log records of nodes. Records are kept as tuples and written in batches to a
+    file, optionally by a background thread. The last records can also be kept in memory.
+
+       Attributes:
+           level (int): Minimum level of records to keep.
+           categories (Set of string): If it is not None, only records of these categories are kept.
+           records (Deque of Tuple): The last records kept in memory, if ring_size is given.
+           buffer_size (int): Number of records buffered before they are written.
+
+    """
+
+    ############################
+    def __init__(self, level=INFO, file='-', ring_size=0, buffer_size=1000, background=False, categories=None):
+        """Constructor for LogSink class.
+
+           Args:
+               level (int): Minimum level of records to keep. OFF disables logging.
+               file (string or file object): File path or file object to write. '-' is the standard output,
+                None disables writing.
+               ring_size (int): Number of the last records kept in memory.
+               buffer_size (int): Number of records buffered before they are written.
+               background (bool): If it is True, records are formatted and written by a background thread.
+               categories (Iterable of string): Categories to keep. If it is None, all categories are kept.
+
+           Returns:
+               LogSink: Created LogSink object.
+        """
+        self.level = level
+        self.categories = set(categories) if categories is not None else None
+        self.records = collections.deque(maxlen=ring_size) if ring_size else None
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._owns_file = isinstance(file, str) and file != '-'
+        if file == '-':
+            self._file = sys.stdout
+        elif self._owns_file:
+            self._file = open(file, 'w')
+        else:
+            self._file = file
+        self._queue = None
+        if background and self._file is not None:
+            self._queue = queue.Queue()
+            thread = threading.Thread(target=self._write_loop, daemon=True)
+            thread.start()
+
+    ############################
+    def write(self, time, id, level, category, msg, args):
+        """Adds a record if it passes the filters.
+
+           Args:
+               time (double): Simulation time.
+               id (int): Node id.
+               level (int): Level of record.
+               category (string): Category of record, it can be None.
+               msg (string): Message, it can contain %-style placeholders.
+               args (Tuple): Arguments of placeholders.
+
+           Returns:
+
+        """
+        if level < self.level or (self.categories is not None and category not in self.categories):
+            return
+        record = (time, id, level, category, msg, args)
+        if self.records is not None:
+            self.records.append(record)
+        if self._file is not None:
+            self._buffer.append(record)
+            if len(self._buffer) >= self.buffer_size:
+                self._emit()
+
+    ############################
+    def messages(self):
+        """Formats the records kept in memory.
+
+           Args:
+
+           Returns:
+               List of string: Formatted lines.
+        """
+        return [format_record(record) for record in self.records or ()]
+
+    ############################
+    def flush(self):
+        """Writes the buffered records. If a background thread is used, waits until it writes them.
+
+           Args:
+
+           Returns:
+
+        """
+        if self._buffer:
+            self._emit()
+        if self._queue is not None:
+            self._queue.join()
+
+    ############################
+    def close(self):
+        """Flushes records and closes the file if it was opened by the sink.
+
+           Args:
+
+           Returns:
+
+        """
+        self.flush()
+        if self._owns_file:
+            self._file.close()
+        self._file = None
+
+    ############################
+    def _emit(self):
+        records, self._buffer = self._buffer, []
+        if self._queue is not None:
+            self._queue.put(records)
+        else:
+            self._write(records)
+
+    ############################
+    def _write(self, records):
+        self._file.write(''.join([format_record(record) + '\n' for record in records]))
+        self._file.flush()
+
+    ############################
+    def _write_loop(self):
+        while True:
+            records = self._queue.get()
+            try:
+                self._write(records)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,683 @@
+"""Mobility models and the engines that move nodes of a Simulator.
+
+A mobility model chooses the legs of a node's trip. An engine moves nodes along those legs and keeps
+neighbor lists up to date. StepMobility advances positions with periodic ticks, AnalyticMobility moves
+nodes on straight lines and computes positions and link changes exactly when they are needed.
+"""
+
+import math
+import numpy as np
+
+EPSILON = 1e-9
+"""double: Time tolerance in seconds. Link changes closer than this to the current time are not predicted.
+"""
+
+
+###########################################################
+def _draw(value, rand):
+    """Returns a fixed value or draws one uniformly from a (low, high) range."""
+    if isinstance(value, (tuple, list)):
+        return rand.uniform(*value)
+    return value
+
+
+###########################################################
+class RandomWaypoint:
+    """Mobility model that moves a node to random points of an area one after another, pausing at each.
+
+       Attributes:
+           area (Tuple(double,double,double,double)): Minimum x, minimum y, maximum x and maximum y.
+           speed (double or Tuple(double,double)): Speed, or range of speeds drawn for each leg.
+           pause (double or Tuple(double,double)): Pause at each waypoint, or range of pauses.
+
+    """
+
+    ############################
+    def __init__(self, area, speed, pause=0):
+        """Constructor for RandomWaypoint class.
+
+           Args:
+               area (Tuple(double,double,double,double)): Minimum x, minimum y, maximum x and maximum y.
+               speed (double or Tuple(double,double)): Speed, or range of speeds drawn for each leg.
+               pause (double or Tuple(double,double)): Pause at each waypoint, or range of pauses.
+
+           Returns:
+               RandomWaypoint: Created RandomWaypoint object.
+        """
+        self.area = area
+        self.speed = speed
+        self.pause = pause
+
+    ############################
+    def next_leg(self, node, rand):
+        """Chooses the next leg of a node.
+
+           Args:
+               node (BaseNode): Moving node.
+               rand (Random): Random object of simulator.
+
+           Returns:
+               Tuple(Tuple(double,double),double,double): Target position, speed and pause after arrival.
+        """
+        (x0, y0, x1, y1) = self.area
+        target = (rand.uniform(x0, x1), rand.uniform(y0, y1))
+        return target, _draw(self.speed, rand), _draw(self.pause, rand)
+
+
+###########################################################
+class RandomDirection(RandomWaypoint):
+    """Mobility model that moves a node in a random direction until it reaches the border of an area,
+    then pauses and chooses a new direction.
+
+       Attributes:
+           area (Tuple(double,double,double,double)): Minimum x, minimum y, maximum x and maximum y.
+           speed (double or Tuple(double,double)): Speed, or range of speeds drawn for each leg.
+           pause (double or Tuple(double,double)): Pause at the border, or range of pauses.
+
+    """
+
+    ############################
+    def next_leg(self, node, rand):
+        """Chooses the next leg of a node.
+
+           Args:
+               node (BaseNode): Moving node.
+               rand (Random): Random object of simulator.
+
+           Returns:
+               Tuple(Tuple(double,double),double,double): Target position, speed and pause after arrival.
+        """
+        (x0, y0, x1, y1) = self.area
+        x = min(max(node.pos[0], x0), x1)
+        y = min(max(node.pos[1], y0), y1)
+        angle = rand.uniform(0, 2 * math.pi)
+        dx, dy = math.cos(angle), math.sin(angle)
+        steps = [(x1 - x) / dx if dx > 0 else (x0 - x) / dx if dx < 0 else math.inf,
+                 (y1 - y) / dy if dy > 0 else (y0 - y) / dy if dy < 0 else math.inf]
+        step = min(steps)
+        target = (min(max(x + dx * step, x0), x1), min(max(y + dy * step, y0), y1))
+        return target, _draw(self.speed, rand), _draw(self.pause, rand)
+
+
+###########################################################
+class Mobility:
+    """Base class of mobility engines. It keeps the mobility models that nodes follow.
+
+       Attributes:
+           sim (Simulator): Simulator of nodes.
+           movers (List of BaseNode): Moving nodes, in the order of array rows.
+           models (Dict of int to object): Mobility model of each node following one, by node id.
+           lazy (bool): If it is True, positions of moving nodes are computed when they are read and
+            distances in neighbor lists are updated only when links change.
+
+    """
+
+    lazy = False
+
+    ############################
+    def __init__(self, sim):
+        """Constructor for Mobility class.
+
+           Args:
+               sim (Simulator): Simulator of nodes.
+
+           Returns:
+               Mobility: Created Mobility object.
+        """
+        self.sim = sim
+        self.movers = []
+        self.models = {}
+        self._rows = {}
+        self._pauses = {}
+
+    ############################
+    def move(self, node, target_pos, speed):
+        """Starts moving a node towards a target position, or changes the target of a moving node. The
+        node stops following its mobility model.
+
+           Args:
+               node (BaseNode): Node to move.
+               target_pos (Tuple(double,double)): Target position.
+               speed (double): Distance taken in 1 second of simulation.
+
+           Returns:
+
+        """
+        self._forget_model(node)
+        node.target_pos = target_pos
+        node.speed = speed
+        self._start(node, target_pos, speed)
+
+    ############################
+    def follow(self, node, model):
+        """Makes a node follow a mobility model, starting from its current position.
+
+           Args:
+               node (BaseNode): Node to move.
+               model (object): Mobility model having a next_leg(node, rand) method, e.g. RandomWaypoint.
+
+           Returns:
+
+        """
+        self._forget_model(node)
+        self.models[node.id] = model
+        self._next_leg(node)
+
+    ############################
+    def stop(self, node):
+        """Stops a node at its current position and forgets its mobility model.
+
+           Args:
+               node (BaseNode): Node to stop.
+
+           Returns:
+
+        """
+        self._forget_model(node)
+        if node.id in self._rows:
+            self._halt(node, node.pos)
+
+    ############################
+    def moving(self, node):
+        """Checks if a node is moved by the engine.
+
+           Args:
+               node (BaseNode): Node to check.
+
+           Returns:
+               bool: True if node is on a leg of its trip.
+        """
+        return node.id in self._rows
+
+    ############################
+    def unindexed(self):
+        """Gets the nodes that are not kept in the spatial index of simulator.
+
+           Args:
+
+           Returns:
+               Iterable of BaseNode: Nodes that neighbor searches should check in addition to the index.
+        """
+        return ()
+
+    ############################
+    def removed(self, node):
+        """It is called before a node fails or is removed. The node is stopped.
+
+           Args:
+               node (BaseNode): Failed node.
+
+           Returns:
+
+        """
+        self.stop(node)
+
+    ############################
+    def added(self, nodes):
+        """It is called after nodes are added to the network.
+
+           Args:
+               nodes (List of BaseNode): Added nodes.
+
+           Returns:
+
+        """
+        pass
+
+    ############################
+    def _next_leg(self, node):
+        """Starts the next leg chosen by the mobility model of node."""
+        self._pauses.pop(node.id, None)
+        target_pos, speed, pause = self.models[node.id].next_leg(node, self.sim.random)
+        node.target_pos = target_pos
+        node.speed = speed
+        node.pause = pause
+        self._start(node, target_pos, speed)
+
+    ############################
+    def _arrived(self, node):
+        """Starts the pause of a node that reached its target, if it follows a mobility model."""
+        if node.id not in self.models:
+            return
+        if node.pause > 0:
+            self._pauses[node.id] = self.sim.env.call_later(node.pause, self._next_leg, node)
+        else:
+            self._next_leg(node)
+
+    ############################
+    def _forget_model(self, node):
+        """Forgets the mobility model of node and cancels its pause."""
+        self.models.pop(node.id, None)
+        entry = self._pauses.pop(node.id, None)
+        if entry is not None:
+            self.sim.env.cancel(entry)
+
+    ############################
+    def _add_row(self, node):
+        """Adds a node to movers and returns its array row."""
+        row = self._rows.get(node.id)
+        if row is None:
+            row = len(self.movers)
+            if row == len(self._arrays[0]):
+                self._arrays = [np.resize(array, (2 * len(array),) + array.shape[1:]) for array in self._arrays]
+            self.movers.append(node)
+            self._rows[node.id] = row
+        return row
+
+    ############################
+    def _remove_row(self, node):
+        """Removes a node from movers. The last row is moved to its place."""
+        row = self._rows.pop(node.id)
+        last = len(self.movers) - 1
+        moved = self.movers.pop()
+        if row != last:
+            self.movers[row] = moved
+            self._rows[moved.id] = row
+            for array in self._arrays:
+                array[row] = array[last]
+
+
+###########################################################
+class StepMobility(Mobility):
+    """Moves all moving nodes with a single periodic tick. Positions, targets and speeds of movers are
+    kept in arrays, so a tick advances every mover in one vectorized step and then updates the neighbor
+    lists of the moved nodes in one batch.
+
+       Attributes:
+           step_time (double): Simulation time between two ticks.
+
+    """
+
+    ############################
+    def __init__(self, sim, step_time):
+        """Constructor for StepMobility class.
+
+           Args:
+               sim (Simulator): Simulator of nodes.
+               step_time (double): Simulation time between two ticks.
+
+           Returns:
+               StepMobility: Created StepMobility object.
+        """
+        super().__init__(sim)
+        self.step_time = step_time
+        # positions, targets, speeds and last update times of movers
+        self._arrays = [np.empty((16, 2)), np.empty((16, 2)), np.empty(16), np.empty(16)]
+        self._tick = None
+
+    ############################
+    def _start(self, node, target_pos, speed):
+        """Starts moving a node towards a target position."""
+        row = self._add_row(node)
+        (pos, target, speeds, last) = self._arrays
+        pos[row] = node.pos
+        target[row] = target_pos
+        speeds[row] = speed
+        last[row] = self.sim.now
+        if self._tick is None:
+            self._tick = self.sim.env.call_later(self.step_time, self.tick)
+
+    ############################
+    def _halt(self, node, pos):
+        """Stops a moving node at a position."""
+        self._remove_row(node)
+        node.pos = pos
+        if not self.movers and self._tick is not None:
+            self.sim.env.cancel(self._tick)
+            self._tick = None
+
+    ############################
+    def tick(self):
+        """Advances every mover by the distance it takes since its last update, then updates neighbor
+        lists of all of them at once. Movers that reach their targets are stopped, or start their next
+        legs if they follow mobility models.
+
+           Args:
+
+           Returns:
+
+        """
+        self._tick = None
+        count = len(self.movers)
+        now = self.sim.now
+        (pos, target, speeds, last) = (array[:count] for array in self._arrays)
+        delta = target - pos
+        dist = np.hypot(delta[:, 0], delta[:, 1])
+        step = speeds * (now - last)
+        arrived = dist <= step
+        ratio = np.divide(step, dist, out=np.zeros(count), where=~arrived)
+        pos += delta * ratio[:, None]
+        pos[arrived] = target[arrived]
+        last[:] = now
+
+        movers = list(self.movers)
+        for (node, new_pos) in zip(movers, pos.tolist()):
+            node.pos = tuple(new_pos)
+        arrivals = [movers[row] for row in np.flatnonzero(arrived)[::-1].tolist()]
+        for node in arrivals:
+            self._halt(node, node.target_pos)
+        self.sim.update_neighbor_lists([node.id for node in movers])
+        for node in arrivals:
+            self._arrived(node)
+        if self.movers and self._tick is None:
+            self._tick = self.sim.env.call_later(self.step_time, self.tick)
+
+
+###########################################################
+class AnalyticMobility(Mobility):
+    """Moves nodes on straight lines without fixed steps. Position of a moving node is computed from its
+    current leg when it is read. For each pair of nodes that can come close, the time when the distance
+    between them crosses a transmission range (or a transmission range plus the neighbor margin) is
+    computed and only that link change is scheduled. Moving nodes are not kept in the spatial index.
+
+    Distances in neighbor lists are updated only at link changes, so they can be out of date for moving
+    nodes, but it is always exact whether a node is in transmission range.
+
+    """
+
+    lazy = True
+
+    ############################
+    def __init__(self, sim):
+        """Constructor for AnalyticMobility class.
+
+           Args:
+               sim (Simulator): Simulator of nodes.
+
+           Returns:
+               AnalyticMobility: Created AnalyticMobility object.
+        """
+        super().__init__(sim)
+        # origins, velocities, start times and end times of current legs, and transmission ranges of movers
+        self._arrays = [np.empty((16, 2)), np.empty((16, 2)), np.empty(16), np.empty(16), np.empty(16)]
+        self._events = {}
+        self._ends = {}
+
+    ############################
+    def unindexed(self):
+        """Gets the nodes that are not kept in the spatial index of simulator.
+
+           Args:
+
+           Returns:
+               Iterable of BaseNode: Moving nodes.
+        """
+        return self.movers
+
+    ############################
+    def added(self, nodes):
+        """Schedules link changes between added nodes and moving nodes.
+
+           Args:
+               nodes (List of BaseNode): Added nodes.
+
+           Returns:
+
+        """
+        if self.movers:
+            for node in nodes:
+                self._predict(node)
+
+    ############################
+    def removed(self, node):
+        """It is called before a node fails or is removed. The node is stopped and its link changes are
+        canceled.
+
+           Args:
+               node (BaseNode): Failed node.
+
+           Returns:
+
+        """
+        self.stop(node)
+        for (other_id, entry) in self._events.pop(node.id, {}).items():
+            del self._events[other_id][node.id]
+            self.sim.env.cancel(entry)
+
+    ############################
+    def _start(self, node, target_pos, speed):
+        """Starts moving a node towards a target position."""
+        pos = node.pos
+        dx, dy = target_pos[0] - pos[0], target_pos[1] - pos[1]
+        duration = math.hypot(dx, dy) / speed if speed > 0 else math.inf
+        if duration == 0:
+            self._end_leg(node, target_pos)
+        elif math.isinf(duration):
+            if node.id in self._rows:
+                self._halt(node, pos)
+        else:
+            self._set_leg(node, pos, (dx / duration, dy / duration), duration, target_pos)
+
+    ############################
+    def _set_leg(self, node, origin, velocity, duration, target_pos):
+        """Puts a node on a new leg starting from the current time and predicts its link changes."""
+        env = self.sim.env
+        now = env.now
+        if node.id not in self._rows:
+            self.sim.grid.remove(node)
+        self._drop_events(node)
+        row = self._add_row(node)
+        (origins, velocities, starts, ends, ranges) = self._arrays
+        origins[row] = origin
+        velocities[row] = velocity
+        starts[row] = now
+        ends[row] = now + duration
+        ranges[row] = node.tx_range
+        node._pos = origin
+        node._motion = (origin[0], origin[1], velocity[0], velocity[1], now, now + duration)
+        entry = self._ends.pop(node.id, None)
+        if entry is not None:
+            env.cancel(entry)
+        if not math.isinf(duration):
+            self._ends[node.id] = env.call_at(now + duration, self._end_leg, node, target_pos)
+        self._predict(node)
+
+    ############################
+    def _end_leg(self, node, target_pos):
+        """Finishes a leg. At the end of a trip the node pauses or stops, at the end of a pause it
+        starts its next leg."""
+        self._ends.pop(node.id, None)
+        if target_pos is None:
+            self._next_leg(node)
+        elif node.id in self.models and node.pause > 0:
+            self._set_leg(node, target_pos, (0, 0), node.pause, None)
+        elif node.id in self.models:
+            now = self.sim.env.now
+            node._motion = (target_pos[0], target_pos[1]) + node._motion[2:4] + (now, now)
+            self._next_leg(node)
+        elif node.id in self._rows:
+            self._halt(node, target_pos)
+
+    ############################
+    def _arrived(self, node):
+        """Pauses are legs with zero velocity, so they are started by _end_leg()."""
+        pass
+
+    ############################
+    def _halt(self, node, pos):
+        """Stops a moving node at a position and puts it back into the spatial index."""
+        self._drop_events(node)
+        entry = self._ends.pop(node.id, None)
+        if entry is not None:
+            self.sim.env.cancel(entry)
+        self._remove_row(node)
+        node._motion = None
+        node._pos = pos
+        self.sim.grid.insert(node)
+        if self.movers:
+            self._predict(node)
+
+    ############################
+    def _drop_events(self, node):
+        """Cancels the link changes scheduled for a node. The ones due now are applied first."""
+        now = self.sim.env.now
+        for (other_id, entry) in self._events.pop(node.id, {}).items():
+            del self._events[other_id][node.id]
+            if entry[0] <= now + EPSILON and entry[2] is not None:
+                self._refresh(*entry[3])
+            self.sim.env.cancel(entry)
+
+    ############################
+    def _pair_event(self, node1, node2):
+        """Applies a link change between two nodes and predicts the next one."""
+        del self._events[node1.id][node2.id]
+        del self._events[node2.id][node1.id]
+        self._refresh(node1, node2)
+        now = self.sim.env.now
+        (x1, y1), (x2, y2) = node1.pos, node2.pos
+        (vx1, vy1, end1), (vx2, vy2, end2) = _velocity(node1), _velocity(node2)
+        radii = [node1.tx_range, node2.tx_range]
+        if self.sim.neighbor_margin:
+            radii += [radius + self.sim.neighbor_margin for radius in radii]
+        time = _first_crossing(x2 - x1, y2 - y1, vx2 - vx1, vy2 - vy1, radii)
+        if time <= min(end1, end2) - now:
+            self._schedule(node1, node2, now + time)
+
+    ############################
+    def _refresh(self, node1, node2):
+        """Updates links between two nodes for their current positions. A distance that is equal to a
+        range within tolerance is counted in range if the nodes are approaching each other."""
+        (x1, y1), (x2, y2) = node1.pos, node2.pos
+        (vx1, vy1, end1), (vx2, vy2, end2) = _velocity(node1), _velocity(node2)
+        dist = math.hypot(x2 - x1, y2 - y1)
+        approaching = (x2 - x1) * (vx2 - vx1) + (y2 - y1) * (vy2 - vy1) < 0
+        margin = self.sim.neighbor_margin
+        for (src, dst) in ((node1, node2), (node2, node1)):
+            tx_range = src.tx_range
+            if _within(dist, tx_range + margin, approaching):
+                if _within(dist, tx_range, approaching):
+                    self.sim._set_link(src, dst, min(dist, tx_range))
+                else:
+                    self.sim._set_link(src, dst, min(max(dist, math.nextafter(tx_range, math.inf)),
+                                                     tx_range + margin))
+            else:
+                self.sim._set_link(src, dst, None)
+
+    ############################
+    def _predict(self, node):
+        """Schedules the next link changes between a node and the moving nodes, and between the node and
+        the nodes of the spatial index around its path."""
+        now = self.sim.env.now
+        (x, y) = node.pos
+        (vx, vy, end) = _velocity(node)
+        count = len(self.movers)
+        others = self.movers
+        (origins, velocities, starts, ends, ranges) = (array[:count] for array in self._arrays)
+        positions = origins + velocities * (now - starts)[:, None]
+        static = []
+        if vx or vy:
+            margin = self.sim.max_tx_range + self.sim.neighbor_margin
+            (x1, y1) = (x + vx * (end - now), y + vy * (end - now))
+            static = list(self._indexed_near(min(x, x1) - margin, min(y, y1) - margin,
+                                             max(x, x1) + margin, max(y, y1) + margin))
+        if static:
+            others = others + static
+            positions = np.concatenate([positions, np.array([n._pos for n in static], dtype=float)])
+            velocities = np.concatenate([velocities, np.zeros((len(static), 2))])
+            ends = np.concatenate([ends, np.full(len(static), math.inf)])
+            ranges = np.concatenate([ranges, np.array([n.tx_range for n in static], dtype=float)])
+        if not others:
+            return
+        radii = [ranges, np.full(len(ranges), node.tx_range)]
+        if self.sim.neighbor_margin:
+            radii += [radius + self.sim.neighbor_margin for radius in radii]
+        horizons = np.minimum(ends, end) - now
+        row = self._rows.get(node.id)
+        if row is not None:
+            horizons[row] = -1
+        times = crossing_times(positions - (x, y), velocities - (vx, vy), np.stack(radii, axis=1), horizons)
+        for i in np.flatnonzero(np.isfinite(times)).tolist():
+            self._schedule(node, others[i], now + times[i])
+
+    ############################
+    def _schedule(self, node1, node2, time):
+        """Schedules a link change between two nodes."""
+        entry = self.sim.env.call_at(time, self._pair_event, node1, node2)
+        self._events.setdefault(node1.id, {})[node2.id] = entry
+        self._events.setdefault(node2.id, {})[node1.id] = entry
+
+    ############################
+    def _indexed_near(self, x0, y0, x1, y1):
+        """Yields the nodes of the spatial index in the cells overlapping a rectangle."""
+        grid = self.sim.grid
+        if grid.cell_size is None:
+            return
+        (cx0, cy0), (cx1, cy1) = grid.cell_of((x0, y0)), grid.cell_of((x1, y1))
+        cells = grid.cells
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+            for members in cells.values():
+                yield from members.values()
+            return
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                members = cells.get((cx, cy))
+                if members:
+                    yield from members.values()
+
+
+###########################################################
+def _velocity(node):
+    """Gets the velocity of a node and the end time of its current leg."""
+    motion = node._motion
+    if motion is None:
+        return (0.0, 0.0, math.inf)
+    return (motion[2], motion[3], motion[5])
+
+
+###########################################################
+def _first_crossing(dx, dy, vx, vy, radii):
+    """Computes the first time a relative trajectory crosses any of radii, like crossing_times() does for
+    a single trajectory."""
+    a = vx * vx + vy * vy
+    if a == 0:
+        return math.inf
+    b = 2 * (dx * vx + dy * vy)
+    c = dx * dx + dy * dy
+    first = math.inf
+    for radius in radii:
+        disc = b * b - 4 * a * (c - radius * radius)
+        if disc < 0:
+            continue
+        root = math.sqrt(disc)
+        for time in ((-b - root) / (2 * a), (-b + root) / (2 * a)):
+            if time > EPSILON:
+                first = min(first, time)
+                break
+    return first
+
+
+###########################################################
+def _within(dist, radius, approaching):
+    """Checks if a distance is in a radius. A distance equal to radius within tolerance is counted in
+    only when the nodes are approaching each other."""
+    if abs(dist - radius) <= EPSILON * max(radius, 1):
+        return approaching
+    return dist < radius
+
+
+###########################################################
+def crossing_times(positions, velocities, radii, horizons):
+    """Computes the first time each relative trajectory crosses any of its radii. A relative trajectory
+    starts at a position and moves with a constant velocity.
+
+       Args:
+           positions (numpy.ndarray): Relative positions with shape (N, 2).
+           velocities (numpy.ndarray): Relative velocities with shape (N, 2).
+           radii (numpy.ndarray): Radii of each trajectory with shape (N, K).
+           horizons (numpy.ndarray): Time after which a trajectory is not valid, with shape (N,).
+
+       Returns:
+           numpy.ndarray: First crossing times later than EPSILON, inf if there is none before the horizon.
+    """
+    a = (velocities ** 2).sum(axis=1)[:, None]
+    b = 2 * (positions * velocities).sum(axis=1)[:, None]
+    c = (positions ** 2).sum(axis=1)[:, None] - radii ** 2
+    disc = b * b - 4 * a * c
+    valid = (a > 0) & (disc >= 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = np.sqrt(np.where(valid, disc, 0))
+        first = np.where(valid, (-b - root) / (2 * a), math.inf)
+        second = np.where(valid, (-b + root) / (2 * a), math.inf)
+    times = np.where(first > EPSILON, first, np.where(second > EPSILON, second, math.inf)).min(axis=1)
+    times[times > horizons] = math.inf
+    return times
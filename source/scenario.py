@@ -0,0 +1,224 @@
+"""Scenario files and topology generators for DawnSim.
+
+A scenario is a JSON file keeping the settings of simulator and groups of nodes. Large arrays are kept
+in a .npz or .npy file next to it and referenced as 'file.npz:key' or 'file.npy'; .npy files are
+memory-mapped. Small arrays can also be written in JSON directly.
+
+    {
+        "simulator": {"duration": 100, "realtime": false, "config": {"delay_type": "prop"}},
+        "params": {"source": 0},
+        "groups": [
+            {"class": "aodv:Node", "positions": "layout.npz:positions_0", "tx_ranges": 75}
+        ]
+    }
+
+Each group is added with a single Simulator.add_nodes() call.
+"""
+
+import importlib
+import json
+import math
+import os
+import numpy as np
+from source.config import SimConfig
+
+
+###########################################################
+def jittered_grid(shape, spacing, jitter=0, origin=(0, 0), rng=None):
+    """Places nodes on a grid and moves each of them randomly around its grid point.
+
+       Args:
+           shape (Tuple(int,int)): Number of columns and rows.
+           spacing (double): Distance between neighboring grid points.
+           jitter (double): Maximum displacement along each axis.
+           origin (Tuple(double,double)): Position of the first grid point.
+           rng (int or numpy.random.Generator): Seed or random generator.
+
+       Returns:
+           numpy.ndarray: Positions, an array with shape (N, 2).
+    """
+    (columns, rows) = shape
+    xs, ys = np.meshgrid(np.arange(columns) * spacing + origin[0], np.arange(rows) * spacing + origin[1],
+                         indexing='ij')
+    positions = np.column_stack([xs.ravel(), ys.ravel()]).astype(float)
+    if jitter:
+        positions += np.random.default_rng(rng).uniform(-jitter, jitter, positions.shape)
+    return positions
+
+
+###########################################################
+def uniform(n, area, rng=None):
+    """Places nodes uniformly at random in an area.
+
+       Args:
+           n (int): Number of nodes.
+           area (Tuple(double,double,double,double)): Minimum x, minimum y, maximum x and maximum y.
+           rng (int or numpy.random.Generator): Seed or random generator.
+
+       Returns:
+           numpy.ndarray: Positions, an array with shape (N, 2).
+    """
+    (x0, y0, x1, y1) = area
+    return np.random.default_rng(rng).uniform((x0, y0), (x1, y1), (n, 2))
+
+
+###########################################################
+def clustered(n, area, clusters, spread, rng=None):
+    """Places nodes in clusters. Cluster centers are uniform in the area and nodes are normally distributed
+    around a random center. Nodes are clipped to the area.
+
+       Args:
+           n (int): Number of nodes.
+           area (Tuple(double,double,double,double)): Minimum x, minimum y, maximum x and maximum y.
+           clusters (int): Number of clusters.
+           spread (double): Standard deviation of distance of nodes to their center along each axis.
+           rng (int or numpy.random.Generator): Seed or random generator.
+
+       Returns:
+           numpy.ndarray: Positions, an array with shape (N, 2).
+    """
+    rng = np.random.default_rng(rng)
+    (x0, y0, x1, y1) = area
+    centers = rng.uniform((x0, y0), (x1, y1), (clusters, 2))
+    positions = centers[rng.integers(clusters, size=n)] + rng.normal(0, spread, (n, 2))
+    return np.clip(positions, (x0, y0), (x1, y1))
+
+
+###########################################################
+def poisson_disc(area, min_distance, rng=None, attempts=30):
+    """Places nodes randomly so that no two nodes are closer than min_distance, until no more nodes fit
+    in most of the area. The area is divided into cells small enough to hold a single node. In each round,
+    a candidate is drawn in every empty cell; cells three apart can not conflict, so candidates are
+    checked in nine vectorized passes.
+
+       Args:
+           area (Tuple(double,double,double,double)): Minimum x, minimum y, maximum x and maximum y.
+           min_distance (double): Minimum distance between nodes.
+           rng (int or numpy.random.Generator): Seed or random generator.
+           attempts (int): Number of rounds. Cells that are still empty after it are left empty.
+
+       Returns:
+           numpy.ndarray: Positions, an array with shape (N, 2).
+    """
+    rng = np.random.default_rng(rng)
+    (x0, y0, x1, y1) = area
+    cell = min_distance / math.sqrt(2)
+    columns = max(1, math.ceil((x1 - x0) / cell))
+    rows = max(1, math.ceil((y1 - y0) / cell))
+    # points of cells with a border of two empty cells, so that neighbors can be read without bounds checks
+    points = np.full((columns + 4, rows + 4, 2), np.nan)
+    is_empty = np.ones((columns, rows), dtype=bool)
+    # nearest cells first, so that most rejected candidates are dropped early
+    offsets = sorted([(dx, dy) for dx in range(-2, 3) for dy in range(-2, 3) if (dx, dy) != (0, 0)],
+                     key=lambda offset: offset[0] ** 2 + offset[1] ** 2)
+    limit = min_distance * min_distance
+    for attempt in range(attempts):
+        for phase_x in range(3):
+            for phase_y in range(3):
+                cx, cy = np.nonzero(is_empty[phase_x::3, phase_y::3])
+                if len(cx) == 0:
+                    continue
+                cx = cx * 3 + phase_x
+                cy = cy * 3 + phase_y
+                candidates = (np.column_stack([cx, cy]) + rng.random((len(cx), 2))) * cell + (x0, y0)
+                valid = (candidates[:, 0] <= x1) & (candidates[:, 1] <= y1)
+                for (dx, dy) in offsets:
+                    (cx, cy, candidates) = (cx[valid], cy[valid], candidates[valid])
+                    other = points[cx + 2 + dx, cy + 2 + dy]
+                    # comparisons with empty cells are False
+                    valid = ~(((candidates - other) ** 2).sum(axis=1) < limit)
+                points[cx[valid] + 2, cy[valid] + 2] = candidates[valid]
+                is_empty[cx[valid], cy[valid]] = False
+    points = points[2:-2, 2:-2].reshape(-1, 2)
+    return points[~np.isnan(points[:, 0])]
+
+
+###########################################################
+def _resolve(name, classes):
+    """Gets a node class by its name in classes or by its 'module:Class' string."""
+    if not isinstance(name, str):
+        return name
+    if classes is not None and name in classes:
+        return classes[name]
+    module_name, _, class_name = name.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+###########################################################
+def _load_array(value, directory, archives):
+    """Reads an array written in JSON or referenced as 'file.npz:key' or 'file.npy'."""
+    if not isinstance(value, str):
+        return np.asarray(value, dtype=float)
+    file_name, _, key = value.partition(':')
+    path = os.path.join(directory, file_name)
+    if not key:
+        return np.load(path, mmap_mode='r')
+    if path not in archives:
+        archives[path] = np.load(path)
+    return archives[path][key]
+
+
+###########################################################
+def load_scenario(path, classes=None):
+    """Reads a scenario file. Node classes are resolved and arrays are loaded.
+
+       Args:
+           path (string): Path of JSON file.
+           classes (Dict of string to Class): Node classes by the names used in file. Names that are not
+            in it are imported as 'module:Class'.
+
+       Returns:
+           Dict: 'simulator' keeps arguments of Simulator with config as a SimConfig, 'params' keeps
+           parameters of scenario and 'groups' keeps a dict of 'class', 'positions' and 'tx_ranges'
+           for each group.
+    """
+    with open(path) as file:
+        data = json.load(file)
+    directory = os.path.dirname(os.path.abspath(path))
+    archives = {}
+    settings = dict(data.get('simulator', {}))
+    if 'config' in settings:
+        settings['config'] = SimConfig(**settings['config'])
+    groups = [{'class': _resolve(group['class'], classes),
+               'positions': _load_array(group['positions'], directory, archives),
+               'tx_ranges': _load_array(group['tx_ranges'], directory, archives)}
+              for group in data['groups']]
+    return {'simulator': settings, 'params': data.get('params', {}), 'groups': groups}
+
+
+###########################################################
+def save_scenario(path, groups, params=None, **settings):
+    """Writes a scenario file. Arrays are written in a .npz file with the same name as the JSON file.
+
+       Args:
+           path (string): Path of JSON file.
+           groups (List of Dict): Groups of nodes, each a dict of 'class' as a 'module:Class' string,
+            'positions' as an array with shape (N, 2) and 'tx_ranges' as a number or an array with shape (N,).
+           params (Dict): Parameters of scenario, they must be JSON serializable.
+           **settings: Arguments of Simulator. config can be a SimConfig or a dict.
+
+       Returns:
+
+    """
+    if isinstance(settings.get('config'), SimConfig):
+        config = settings['config']
+        settings['config'] = {'delay_type': config.delay_type, 'constant_delay': config.constant_delay,
+                              'move_step_time': config.move_step_time, 'mobility_type': config.mobility_type}
+    archive_path = os.path.splitext(path)[0] + '.npz'
+    archive_name = os.path.basename(archive_path)
+    arrays = {}
+    entries = []
+    for (i, group) in enumerate(groups):
+        entry = {'class': group['class']}
+        for key in ('positions', 'tx_ranges'):
+            value = group[key]
+            if np.ndim(value) == 0:
+                entry[key] = float(value)
+            else:
+                arrays[f'{key}_{i}'] = np.asarray(value, dtype=float)
+                entry[key] = f'{archive_name}:{key}_{i}'
+        entries.append(entry)
+    if arrays:
+        np.savez(archive_path, **arrays)
+    with open(path, 'w') as file:
+        json.dump({'simulator': settings, 'params': params or {}, 'groups': entries}, file, indent=4)
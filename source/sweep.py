@@ -0,0 +1,257 @@
+"""Parallel replications and parameter sweeps over DawnSim scenarios.
+
+A scenario is a function that takes keyword parameters and a seed, and returns a Simulator with nodes
+added but not run yet. It should create the Simulator with realtime=False. Each run is executed in a
+worker process, and the values returned by finish() of nodes are collected in a single table.
+
+Node outputs are dropped unless a log directory is given, then each run writes them to its own file.
+
+Usage from command line:
+
+    python -m source.sweep my_module:create_sim -p tx_range=50,75,100 -r 10 -o results.csv --log-dir logs
+"""
+
+import argparse
+import ast
+import concurrent.futures
+import csv
+import importlib
+import itertools
+import os
+import random
+import sys
+import numpy as np
+from source.logsink import LogSink, OFF
+
+
+###########################################################
+def parameter_grid(grid):
+    """Expands a parameter grid into all combinations.
+
+       Args:
+           grid (Dict of string to List): Values of each parameter.
+
+       Returns:
+           List of Dict: A dict of parameters for each combination.
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+###########################################################
+def _resolve(scenario):
+    """Gets the scenario function from a 'module:function' string."""
+    if callable(scenario):
+        return scenario
+    module_name, _, name = scenario.partition(':')
+    return getattr(importlib.import_module(module_name), name)
+
+
+###########################################################
+def run_scenario(scenario, params, seed, log_file=None):
+    """Creates and runs a single simulation. It is executed in worker processes.
+
+       Args:
+           scenario (Function or string): Scenario function or its 'module:function' name.
+           params (Dict): Parameters passed to scenario.
+           seed (int): Seed of the run. Global random generators are also seeded with it.
+           log_file (string): File to write node outputs. If it is None, they are dropped.
+
+       Returns:
+           Dict: 'results' keeps finish() outputs of nodes by node id, 'time' keeps the end time of simulation.
+    """
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    sim = _resolve(scenario)(seed=seed, **params)
+    if sim.realtime:
+        raise ValueError('sweep scenarios should create Simulator with realtime=False')
+    if log_file is None:
+        sim.log_sink = LogSink(level=OFF, file=None)
+    else:
+        sim.log_sink = LogSink(file=log_file)
+    try:
+        sim.run()
+    finally:
+        sim.log_sink.close()
+    return {'results': sim.results, 'time': sim.now}
+
+
+###########################################################
+def _submit(pool, scenario, job, log_dir):
+    """Submits a job to a process pool, with a log file named after its run index if log_dir is given."""
+    log_file = None if log_dir is None else os.path.join(log_dir, f'run_{job[0]}.log')
+    return pool.submit(run_scenario, scenario, job[2], job[3], log_file)
+
+
+###########################################################
+def _rows(job, outcome):
+    """Converts the outcome of a run into result table rows."""
+    (index, replication, params, seed) = job
+    base = {'run': index, 'replication': replication, 'seed': seed}
+    base.update(params)
+    if 'error' in outcome:
+        return [dict(base, error=outcome['error'])]
+    rows = []
+    for (id, result) in outcome['results'].items():
+        row = dict(base, node=id)
+        if isinstance(result, dict):
+            row.update(result)
+        else:
+            row['result'] = result
+        rows.append(row)
+    return rows or [dict(base, node=None)]
+
+
+###########################################################
+def _run_shared(scenario, jobs, processes, outcomes, log_dir):
+    """Runs jobs in a shared process pool. Returns the jobs that were in progress when a worker crashed."""
+    pending = list(reversed(jobs))
+    suspects = []
+    while pending:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            running = {}
+            while pending or running:
+                # keep only as many runs in the pool as there are workers, so a crash affects only them
+                while pending and len(running) < processes:
+                    job = pending.pop()
+                    running[_submit(pool, scenario, job, log_dir)] = job
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                if _collect(done, running, outcomes):
+                    suspects.extend(running.values())
+                    break
+    return suspects
+
+
+###########################################################
+def _run_isolated(scenario, jobs, processes, outcomes, log_dir):
+    """Runs each job in its own process pool, so a crash is blamed on the right job. Returns crashed jobs."""
+    crashed = []
+    for start in range(0, len(jobs), processes):
+        pools = []
+        running = {}
+        for job in jobs[start:start + processes]:
+            pools.append(concurrent.futures.ProcessPoolExecutor(1))
+            running[_submit(pools[-1], scenario, job, log_dir)] = job
+        concurrent.futures.wait(running)
+        for future in list(running):
+            if _collect([future], running, outcomes):
+                crashed.append(running.pop(future))
+        for pool in pools:
+            pool.shutdown()
+    return crashed
+
+
+###########################################################
+def _collect(done, running, outcomes):
+    """Stores outcomes of finished futures. Returns True if the pool is broken, then broken jobs are kept
+    in running."""
+    broken = False
+    for future in done:
+        try:
+            outcomes[running[future][0]] = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            broken = True
+            continue
+        except Exception as error:
+            outcomes[running[future][0]] = {'error': f'{type(error).__name__}: {error}'}
+        del running[future]
+    return broken
+
+
+###########################################################
+def sweep(scenario, grid=None, replications=1, seed=0, processes=None, retries=2, log_dir=None):
+    """Runs a scenario for every combination of parameters and replication in a process pool.
+    Every run gets an independent seed derived from the given seed. Exceptions in a run are reported in
+    its rows. If a worker process crashes, the runs in progress are run again, each in its own process,
+    so that only the run that crashes is reported as failed.
+
+       Args:
+           scenario (Function or string): Scenario function defined at module level, or its
+            'module:function' name.
+           grid (Dict of string to List): Values of each parameter.
+           replications (int): Number of runs for each combination of parameters.
+           seed (int): Seed to derive the seed of each run.
+           processes (int): Number of worker processes. If it is None, number of CPUs is used.
+           retries (int): How many times a run is retried in its own process after a worker crashes while
+            it is in progress. If it is 0, such runs are reported as failed without retrying.
+           log_dir (string): Directory to write node outputs of each run as run_<index>.log. If it is None,
+            node outputs are dropped.
+
+       Returns:
+           List of Dict: Result table. Each row keeps run index, replication, seed, parameters, node id and
+           the output of finish() of that node. If finish() returns a dict, its items become columns.
+    """
+    combinations = parameter_grid(grid or {})
+    seeds = np.random.SeedSequence(seed).generate_state(len(combinations) * replications).tolist()
+    jobs = [(i, replication, params, seeds[i])
+            for i, (params, replication) in enumerate(itertools.product(combinations, range(replications)))]
+    processes = processes or os.cpu_count()
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+    outcomes = {}
+    suspects = _run_shared(scenario, jobs, processes, outcomes, log_dir)
+    for attempt in range(retries):
+        if not suspects:
+            break
+        suspects = _run_isolated(scenario, suspects, processes, outcomes, log_dir)
+    for job in suspects:
+        outcomes[job[0]] = {'error': 'worker process crashed'}
+    return [row for job in jobs for row in _rows(job, outcomes[job[0]])]
+
+
+###########################################################
+def write_csv(rows, file):
+    """Writes a result table as CSV.
+
+       Args:
+           rows (List of Dict): Result table.
+           file (file object): File to write.
+
+       Returns:
+
+    """
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    writer = csv.DictWriter(file, fieldnames=columns)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+###########################################################
+def _parse_values(text):
+    values = []
+    for item in text.split(','):
+        try:
+            values.append(ast.literal_eval(item))
+        except (ValueError, SyntaxError):
+            values.append(item)
+    return values
+
+
+###########################################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a DawnSim scenario for a grid of parameters.')
+    parser.add_argument('scenario', help="scenario function as 'module:function'")
+    parser.add_argument('-p', '--param', action='append', default=[], metavar='NAME=V1,V2',
+                        help='values of a parameter, can be repeated')
+    parser.add_argument('-r', '--replications', type=int, default=1)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('-o', '--output', default=None, help='CSV file to write, standard output by default')
+    parser.add_argument('--log-dir', default=None, help='directory to write node outputs of each run')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd())
+    grid = {}
+    for param in args.param:
+        name, _, values = param.partition('=')
+        grid[name] = _parse_values(values)
+    rows = sweep(args.scenario, grid, args.replications, args.seed, args.processes, log_dir=args.log_dir)
+    if args.output is None:
+        write_csv(rows, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as file:
+            write_csv(rows, file)
+
+
+if __name__ == '__main__':
+    main()
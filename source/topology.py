@@ -0,0 +1,163 @@
+"""Analyses of network topology on a compressed sparse row adjacency.
+
+The adjacency is given by Simulator.adjacency() as indptr, indices and distances arrays: out-links of
+node i are indices[indptr[i]:indptr[i + 1]]. All analyses are vectorized with numpy.
+"""
+
+import numpy as np
+
+
+###########################################################
+def degrees(indptr):
+    """Gets the number of out-links of every node.
+
+       Args:
+           indptr (numpy.ndarray): Row pointers of adjacency.
+
+       Returns:
+           numpy.ndarray: Out-degree of each node.
+    """
+    return np.diff(indptr)
+
+
+###########################################################
+def in_degrees(indptr, indices):
+    """Gets the number of in-links of every node.
+
+       Args:
+           indptr (numpy.ndarray): Row pointers of adjacency.
+           indices (numpy.ndarray): Link destinations of adjacency.
+
+       Returns:
+           numpy.ndarray: In-degree of each node.
+    """
+    return np.bincount(indices, minlength=len(indptr) - 1)
+
+
+###########################################################
+def _sources(indptr):
+    """Gets the source node of every link."""
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+
+###########################################################
+def connected_components(indptr, indices):
+    """Finds connected components, ignoring the direction of links. Components are merged by hooking
+    every root to the smallest root it is linked to, then by pointer jumping, in a few vectorized rounds.
+
+       Args:
+           indptr (numpy.ndarray): Row pointers of adjacency.
+           indices (numpy.ndarray): Link destinations of adjacency.
+
+       Returns:
+           Tuple(int,numpy.ndarray): Number of components and component label of each node. Labels are
+           numbered from 0 in the order of the smallest node id in each component.
+    """
+    count = len(indptr) - 1
+    labels = np.arange(count)
+    srcs = _sources(indptr)
+    dsts = indices
+    while True:
+        src_labels = labels[srcs]
+        dst_labels = labels[dsts]
+        crossing = src_labels != dst_labels
+        if not crossing.any():
+            break
+        src_labels = src_labels[crossing]
+        dst_labels = dst_labels[crossing]
+        np.minimum.at(labels, src_labels, dst_labels)
+        np.minimum.at(labels, dst_labels, src_labels)
+        while True:
+            parents = labels[labels]
+            if np.array_equal(parents, labels):
+                break
+            labels = parents
+    roots, labels = np.unique(labels, return_inverse=True)
+    return len(roots), labels
+
+
+###########################################################
+def is_connected(indptr, indices):
+    """Checks whether all nodes are in a single connected component, ignoring the direction of links.
+
+       Args:
+           indptr (numpy.ndarray): Row pointers of adjacency.
+           indices (numpy.ndarray): Link destinations of adjacency.
+
+       Returns:
+           bool: True if network is connected.
+    """
+    return connected_components(indptr, indices)[0] <= 1
+
+
+###########################################################
+def bfs(indptr, indices, source):
+    """Finds the number of hops from a node to every node along links, one frontier at a time.
+
+       Args:
+           indptr (numpy.ndarray): Row pointers of adjacency.
+           indices (numpy.ndarray): Link destinations of adjacency.
+           source (int): Id of the first node.
+
+       Returns:
+           numpy.ndarray: Number of hops to each node. It is -1 for nodes that are not reachable.
+    """
+    hops = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    hops[source] = 0
+    frontier = np.array([source])
+    level = 0
+    while len(frontier):
+        level += 1
+        starts = indptr[frontier]
+        counts = indptr[frontier + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            break
+        ends = np.cumsum(counts)
+        within = np.arange(total) - np.repeat(ends - counts, counts)
+        reached = indices[np.repeat(starts, counts) + within]
+        reached = np.unique(reached[hops[reached] < 0])
+        hops[reached] = level
+        frontier = reached
+    return hops
+
+
+###########################################################
+def reachable(indptr, indices, source):
+    """Finds the nodes that can be reached from a node along links.
+
+       Args:
+           indptr (numpy.ndarray): Row pointers of adjacency.
+           indices (numpy.ndarray): Link destinations of adjacency.
+           source (int): Id of the first node.
+
+       Returns:
+           numpy.ndarray: Boolean mask of reachable nodes, including source.
+    """
+    return bfs(indptr, indices, source) >= 0
+
+
+###########################################################
+def diameter_estimate(indptr, indices, source=0, sweeps=4):
+    """Estimates the diameter in hops of the part of network reachable from a node. Each sweep runs a
+    breadth-first search from the farthest node found by the previous one. The result is a lower bound,
+    which is usually exact or close for wireless networks.
+
+       Args:
+           indptr (numpy.ndarray): Row pointers of adjacency.
+           indices (numpy.ndarray): Link destinations of adjacency.
+           source (int): Id of the first node.
+           sweeps (int): Number of searches.
+
+       Returns:
+           int: Estimated diameter.
+    """
+    diameter = 0
+    for sweep in range(sweeps):
+        hops = bfs(indptr, indices, source)
+        farthest = int(np.argmax(hops))
+        if hops[farthest] <= diameter and sweep > 0:
+            break
+        diameter = int(hops[farthest])
+        source = farthest
+    return diameter
@@ -1,3 +1,5 @@
+from collections import deque
+from functools import wraps
 from .common import *
 try:
     from Tkinter import *
@@ -13,18 +15,42 @@ def colorStr(color):
     else:
         return '#%02x%02x%02x' % tuple(int(x*255) for x in color)
 
+###############################################
+def queued(_func_):
+    """
+    Make a drawing command safe to call from any thread.  The command is only
+    appended to the command queue of the plotter, and it is executed later in
+    the Tk main loop by flush()
+    """
+    @wraps(_func_)
+    def _wrap_(self, *args, **kwargs):
+        self.commands.append((_func_, args, kwargs))
+    return _wrap_
+
 ###############################################
 class Plotter(GenericPlotter):
-    def __init__(self, windowTitle='TopoVis', terrain_size=None, params=None):
+    """
+    Draw a scene on a Tk canvas.  Commands may come from a simulation thread,
+    so they are queued and executed in batches by a callback in the Tk main
+    loop, at most fps times a second.  Moved nodes and the time label are
+    redrawn once per frame.
+    """
+    def __init__(self, windowTitle='TopoVis', terrain_size=None, params=None, fps=30):
         GenericPlotter.__init__(self, params)
         self.nodes = {}
         self.links = {}
         self.nodeLinks = {}
         self.lineStyles = {}
         self.shapes = {}
+        self.shapeKinds = {}
         self.windowTitle = windowTitle
+        self.frameTime = max(1, int(1000/fps))
+        self.commands = deque()
+        self.movedNodes = set()
+        self.shownTime = None
         self.prepareCanvas(terrain_size)
         self.lastShownTime = 0
+        self.tk.after(self.frameTime, self.flush)
 
     ###################
     def prepareCanvas(self,terrain_size=None):
@@ -38,11 +64,30 @@ class Plotter(GenericPlotter):
         self.canvas.pack(fill=BOTH, expand=YES)
         self.timeText = self.canvas.create_text(0,0,text="time=0.0",anchor=NW)
 
+    ###################
+    def flush(self):
+        """
+        Execute the queued commands, redraw the nodes moved and the time
+        changed since the last frame, then schedule the next frame
+        """
+        try:
+            commands = self.commands
+            # commands queued while draining are left to the next frame
+            for i in range(len(commands)):
+                (func, args, kwargs) = commands.popleft()
+                func(self, *args, **kwargs)
+            moved, self.movedNodes = self.movedNodes, set()
+            for id in moved:
+                self.updateNodePosAndSize(id)
+            if self.shownTime is not None and self.shownTime != self.lastShownTime:
+                self.canvas.itemconfigure(self.timeText, text='Time: %.2fS' % self.shownTime)
+                self.lastShownTime = self.shownTime
+        finally:
+            self.tk.after(self.frameTime, self.flush)
+
     ###################
     def setTime(self, time):
-        if (time - self.lastShownTime > 0.05):
-            self.canvas.itemconfigure(self.timeText, text='Time: %.2fS' % time)
-            self.lastShownTime = time
+        self.shownTime = time
 
     ###################
     def updateNodePosAndSize(self,id):
@@ -111,52 +156,63 @@ class Plotter(GenericPlotter):
 
 
     ###################
+    @queued
     def node(self,id,x,y):
         self.nodeLinks[id] = []
         self.updateNodePosAndSize(id)
-        self.tk.update()
 
     ###################
+    @queued
     def nodemove(self,id,x,y):
-        self.updateNodePosAndSize(id)
-        self.tk.update()
+        self.movedNodes.add(id)
 
     ###################
+    @queued
     def nodecolor(self,id,r,g,b):
         (node_tag,label_tag) = self.nodes[id]
         self.canvas.itemconfig(node_tag, outline=colorStr((r,g,b)))
         self.canvas.itemconfigure(label_tag, fill=colorStr((r,g,b)))
-        self.tk.update()
 
     ###################
+    @queued
     def nodewidth(self,id,width):
         (node_tag,label_tag) = self.nodes[id]
         self.canvas.itemconfig(node_tag, width=width)
-        self.tk.update()
 
     ###################
+    @queued
     def nodescale(self,id,scale):
         # scale attribute has been set by TopoVis
-        # just update the node
-        self.updateNodePosAndSize(id)
-        self.tk.update()
+        # just update the node in the next frame
+        self.movedNodes.add(id)
 
     ###################
+    @queued
     def nodelabel(self,id,label):
         (node_tag,label_tag) = self.nodes[id]
         self.canvas.itemconfigure(label_tag, text=self.scene.nodes[id].label)
-        self.tk.update()
 
     ###################
+    @queued
     def addlink(self,src,dst,style):
         if style == 'edge' and src > dst:
             src, dst = dst, src
         self.nodeLinks[src].append((src,dst,style))
         self.nodeLinks[dst].append((src,dst,style))
         self.links[(src,dst,style)] = self.createLink(src, dst, style)
-        self.tk.update()
 
     ###################
+    @queued
+    def addlinks(self,links,style):
+        for (src,dst) in links:
+            if style == 'edge' and src > dst:
+                src, dst = dst, src
+            self.nodeLinks[src].append((src,dst,style))
+            self.nodeLinks[dst].append((src,dst,style))
+            self.links[(src,dst,style)] = self.createLink(src, dst, style)
+
+    ###################
+    @queued
     def dellink(self,src,dst,style):
         if style == 'edge' and src > dst:
             src, dst = dst, src
@@ -164,45 +220,74 @@ class Plotter(GenericPlotter):
         self.nodeLinks[dst].remove((src,dst,style))
         self.canvas.delete(self.links[(src,dst,style)])
         del self.links[(src,dst,style)]
-        self.tk.update()
 
     ###################
+    @queued
     def clearlinks(self):
         self.canvas.delete('link')
         self.links.clear()
         for n in self.nodes.keys():
             self.nodeLinks[n] = []
-        self.tk.update()
 
     ###################
+    @queued
     def circle(self,x,y,r,id,linestyle,fillstyle):
-        if id in self.shapes.keys():
-            self.canvas.delete(self.shapes[id])
-            del self.shapes[id]
-        self.shapes[id] = self.canvas.create_oval(x-r,y-r,x+r,y+r)
-        self.configPolygon(self.shapes[id], linestyle, fillstyle)
-        self.tk.update()
+        shape = self.reuseShape(id, 'oval')
+        if shape is None:
+            shape = self.shapes[id] = self.canvas.create_oval(x-r,y-r,x+r,y+r)
+        else:
+            self.canvas.coords(shape, x-r, y-r, x+r, y+r)
+        self.configPolygon(shape, linestyle, fillstyle)
 
     ###################
+    @queued
     def line(self,x1,y1,x2,y2,id,linestyle):
-        if id in self.shapes.keys():
-            self.canvas.delete(self.shapes[id])
-            del self.shapes[id]
-        self.shapes[id] = self.canvas.create_line(x1,y1,x2,y2)
-        self.configLine(self.shapes[id], linestyle)
-        self.tk.update()
+        shape = self.reuseShape(id, 'line')
+        if shape is None:
+            shape = self.shapes[id] = self.canvas.create_line(x1,y1,x2,y2)
+        else:
+            self.canvas.coords(shape, x1, y1, x2, y2)
+        self.configLine(shape, linestyle)
 
     ###################
+    @queued
     def rect(self,x1,y1,x2,y2,id,linestyle,fillstyle):
-        if id in self.shapes.keys():
-            self.canvas.delete(self.shapes[id])
+        shape = self.reuseShape(id, 'rect')
+        if shape is None:
+            shape = self.shapes[id] = self.canvas.create_rectangle(x1,y1,x2,y2)
+        else:
+            self.canvas.coords(shape, x1, y1, x2, y2)
+        self.configPolygon(shape, linestyle, fillstyle)
+
+    ###################
+    def reuseShape(self,id,kind):
+        """
+        Return the canvas item of an existing shape with the same id and kind,
+        shown again, so that it is only moved instead of created.  A shape of
+        another kind is deleted
+        """
+        if id not in self.shapes:
+            self.shapeKinds[id] = kind
+            return None
+        shape = self.shapes[id]
+        if self.shapeKinds[id] != kind:
+            self.canvas.delete(shape)
             del self.shapes[id]
-        self.shapes[id] = self.canvas.create_rectangle(x1,y1,x2,y2)
-        self.configPolygon(self.shapes[id], linestyle, fillstyle)
-        self.tk.update()
+            self.shapeKinds[id] = kind
+            return None
+        self.canvas.itemconfigure(shape, state=NORMAL)
+        return shape
+
+    ###################
+    @queued
+    def hideshape(self,id):
+        if id in self.shapes.keys():
+            self.canvas.itemconfigure(self.shapes[id], state=HIDDEN)
 
     ###################
+    @queued
     def delshape(self,id):
         if id in self.shapes.keys():
             self.canvas.delete(self.shapes[id])
-            self.tk.update()
+            del self.shapes[id]
+            del self.shapeKinds[id]
@@ -1,6 +1,7 @@
 from time import sleep, time as systime
-from threading import Timer
+from threading import Condition, Thread
 from heapq import heappush, heappop
+from itertools import count
 import inspect
 
 from .common import *
@@ -41,6 +42,7 @@ class GenericPlotter:
     def nodelabel(self,id,label): pass
     def nodescale(self,id,scale): pass
     def addlink(self,src,dst,style): pass
+    def addlinks(self,links,style): pass
     def dellink(self,src,dst,style): pass
     def clearlinks(self): pass
     def show(self): pass
@@ -48,6 +50,7 @@ class GenericPlotter:
     def line(self,x1,y1,x2,y2,id,linestyle): pass
     def rect(self,x1,y1,x2,y2,id,linestyle,fillstyle): pass
     def delshape(self,id): pass
+    def hideshape(self,id): pass
     def linestyle(self,id,**kwargs): pass
     def fillstyle(self,id,**kwargs): pass
     def textstyle(self,id,**kwargs): pass
@@ -81,6 +84,60 @@ def informPlotters(_func_):
     ret.__doc__ = _func_.__doc__
     return ret
 
+###############################################
+class Scheduler:
+    """
+    Run delayed commands in a single background thread.  Pending commands
+    are kept in a heap of [time, sequence, command, args, kwargs] entries;
+    every command that is due is run in one batch when the thread wakes up.
+    """
+
+    ###################
+    def __init__(self):
+        self.heap = []
+        self.sequence = count()
+        self.condition = Condition()
+        self.thread = None
+
+    ###################
+    def schedule(self, delay, cmd, *args, **kwargs):
+        """
+        Run cmd with the given arguments after delay seconds.  The returned
+        entry can be passed to cancel()
+        """
+        entry = [systime()+delay, next(self.sequence), cmd, args, kwargs]
+        with self.condition:
+            heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+            elif self.heap[0] is entry:
+                self.condition.notify()
+        return entry
+
+    ###################
+    def cancel(self, entry):
+        """
+        Cancel a scheduled command.  Nothing happens if it has already run
+        """
+        entry[2] = entry[3] = entry[4] = None
+
+    ###################
+    def _run(self):
+        heap = self.heap
+        while True:
+            with self.condition:
+                while not heap or heap[0][0] > systime():
+                    self.condition.wait(heap[0][0]-systime() if heap else None)
+                now = systime()
+                due = []
+                while heap and heap[0][0] <= now:
+                    entry = heappop(heap)
+                    if entry[2] is not None:
+                        due.append(entry)
+            for (t,seq,cmd,args,kwargs) in due:
+                cmd(*args, **kwargs)
+
 ###############################################
 class Scene:
     """
@@ -103,6 +160,8 @@ class Scene:
         self.timescale = timescale
         self.realtime = realtime
         self.evq = []        # Event queue
+        self.evseq = count() # Sequence of events with the same time
+        self.scheduler = None
         self.uniqueId = 0    # Counter for generating unique IDs
 
         self.dim = (0,0)     # Terrain dimension
@@ -157,7 +216,9 @@ class Scene:
             # examine the event queue and execute everything prior to
             # the 'current time'
             while len(self.evq) > 0 and self.evq[0][0] < time:
-                (t,proc,a,kw) = heappop(self.evq)
+                (t,seq,proc,a,kw) = heappop(self.evq)
+                if proc is None:
+                    continue
                 self.setTime(t)
                 proc(*a,**kw)
             self.setTime(time)
@@ -171,17 +232,32 @@ class Scene:
     def executeAfter(self, delay, cmd, *args, **kwargs):
         """
         (Use internally) Wait until the specified delay, then executed the given
-        command
+        command.  In realtime mode, all delayed commands share a single
+        scheduler thread.  The returned entry can be passed to cancel()
         """
         if delay is INF:
             # no need to scedule any execution at time infinity
             return
         if self.realtime:
-            def execfn():
-                self.execute(0, cmd, *args, **kwargs)
-            Timer(delay, execfn).start()
+            if self.scheduler is None:
+                self.scheduler = Scheduler()
+            return self.scheduler.schedule(delay, self.execute, 0, cmd, *args, **kwargs)
+        else:
+            entry = [self.time+delay, next(self.evseq), cmd, args, kwargs]
+            heappush(self.evq, entry)
+            return entry
+
+    ###################
+    def cancel(self, entry):
+        """
+        Cancel a command scheduled with executeAfter()
+        """
+        if entry is None:
+            return
+        if self.realtime:
+            self.scheduler.cancel(entry)
         else:
-            heappush(self.evq, (self.time+delay, cmd, args, kwargs))
+            entry[2] = entry[3] = entry[4] = None
 
     ###################
     def setTime(self,time):
@@ -316,6 +392,19 @@ class Scene:
             src, dst = dst, src
         self.links.add((src,dst,style))
 
+    ###################
+    @informPlotters
+    def addlinks(self,links,style):
+        """
+        (Scene scripting command)
+        Add many links with the same style at once.  links is a list of
+        (src,dst) pairs
+        """
+        for (src,dst) in links:
+            if style == 'edge' and src > dst:
+                src, dst = dst, src
+            self.links.add((src,dst,style))
+
     ###################
     @informPlotters
     def dellink(self,src,dst,style):
@@ -423,6 +512,16 @@ class Scene:
         """
         pass
 
+    ###################
+    @informPlotters
+    def hideshape(self,id):
+        """
+        (Scene scripting command)
+        Hide a shape previously created with ID id.  Drawing a shape with the
+        same ID again shows it, so that the plotter can reuse it
+        """
+        pass
+
     ###################
     @informPlotters
     def linestyle(self,id,**kwargs):